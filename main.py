@@ -1,7 +1,8 @@
 from pyarconline import ArcOnlineHelper
-from flask import Flask, request, jsonify, send_file
+from pyarconline.encoding import MIME_TYPES, encoding_options
+from flask import Flask, request, jsonify, Response
 
-helper = ArcOnlineHelper("ACCOUNT", "PASSWORD")
+helper: ArcOnlineHelper = None
 app = Flask(__name__)
 
 
@@ -10,16 +11,38 @@ async def b30_pic():
     try:
         username = request.args.get('username')
         json_only = request.args.get('jsonOnly', default=False)
-        ans = await helper.handle_task(username, 'b30', json_only=json_only)
         if json_only:
+            ans = await helper.handle_task(username, 'b30', json_only=json_only)
             return jsonify(ans)
-        else:
-            return send_file(ans, mimetype='image/png')
+        options = encoding_options(request.args.get('format'), request.args.get('quality', type=int),
+                                   request.args.get('compressLevel', type=int),
+                                   request.args.get('previewWidth', type=int))
+        ans = await helper.handle_task(username, 'b30', image_format=options[0], quality=options[1],
+                                       compress_level=options[2], preview_width=options[3])
+        return Response(ans, mimetype=MIME_TYPES[options[0]])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/scores', methods=['GET'])
+async def scores():
+    try:
+        username = request.args.get('username')
+        filters = {
+            'difficulty': request.args.get('difficulty', type=int),
+            'min_rating': request.args.get('minRating', type=float),
+            'max_rating': request.args.get('maxRating', type=float),
+            'played_after': request.args.get('playedAfter', type=int),
+        }
+        lines = await helper.iter_scores_ndjson(username, **filters)
+        return Response(lines, mimetype='application/x-ndjson')
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 
 if __name__ == '__main__':
+    # render processes (RENDER_PROCESSES > 0) re-import this file, only the main process may log in
+    helper = ArcOnlineHelper("ACCOUNT", "PASSWORD")
     app.run(debug=True)
 
 # import asyncio
@@ -30,3 +53,8 @@ if __name__ == '__main__':
 # d = DifficultyRatingList(s)
 #
 # asyncio.run(d.update_via_wikiwiki())
+#
+# # pre-resizes every renderer asset into save/assets.pack, rerun it after updating the assets
+# from pyarconline.assetpack import build_asset_pack
+#
+# build_asset_pack()
@@ -1,5 +1,10 @@
 from .config import *
 from .utils import WebapiUtils, SongList, DifficultyRatingList, FriendManager
+from .ratelimiter import RateLimiter
+from .storage import ScoreStore
+from .friendslots import FriendSlots
+from .asyncwebapi import AsyncWebapiUtils
 from .exceptions import *
 from .worker import WorkerLauncher
+from .scheduler import RefreshScheduler
 from .arconlinehelper import *
@@ -1,35 +1,75 @@
+import asyncio
 import atexit
-import sqlite3
+import json
+import threading
 from pyarconline.utils import *
 from pyarconline.exceptions import *
 from pyarconline.worker import WorkerLauncher
-from pyarconline.config import DB_PATH, SONGLIST_PATH
+from pyarconline.scheduler import RefreshScheduler
+from pyarconline.config import SONGLIST_PATH, WARM_UP_ASSETS, REFRESH_INTERVAL
+from pyarconline.cache import ASSET_CACHE, RESULT_CACHE
+from pyarconline.storage import ScoreStore, connect, SCORE_COLUMNS
 
 
 class ArcOnlineHelper:
+    """
+    Logs in, keeps the scores of every friend and hands b30 requests to the workers.
+
+    With RENDER_PROCESSES > 0, images are drawn in worker processes started with forkserver/spawn,
+    which import the main module of the program again. Create the helper under
+    if __name__ == '__main__' (or in an app factory), never at module level of the script that runs it,
+    otherwise every render process logs in and starts its own workers.
+    """
+
     def __init__(self, username, password):
-        song_list = SongList(SONGLIST_PATH)
-        self.difficulty_rating = DifficultyRatingList(song_list)
+        self._prepare()
         self.webapi = WebapiUtils()
         self.login(username, password)
-        self.friend_manager = FriendManager(self.webapi)
-        self.launcher = WorkerLauncher(song_list, self.difficulty_rating, self.webapi, self.friend_manager)
-        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        self._start(FriendManager(self.webapi))
+
+    @classmethod
+    async def create(cls, username, password):
+        """
+        warm start: logs in and fetches the friend list in an executor while the songlist, the ratings
+        and the database are prepared in another one, then starts the workers.
+        """
+        self = cls.__new__(cls)
+        self.webapi = WebapiUtils()
+
+        def connect_account():
+            self.login(username, password)
+            return FriendManager(self.webapi)
+
+        loop = asyncio.get_running_loop()
+        friend_manager, _ = await asyncio.gather(loop.run_in_executor(None, connect_account),
+                                                 loop.run_in_executor(None, self._prepare))
+        self._start(friend_manager)
+        return self
+
+    def _prepare(self):
+        """
+        everything that does not need the account: assets (in the background), ratings and the database.
+        """
+        if WARM_UP_ASSETS:
+            threading.Thread(target=ASSET_CACHE.warm_up, name="asset-warm-up", daemon=True).start()
+        self.song_list = SongList(SONGLIST_PATH)
+        self.difficulty_rating = DifficultyRatingList(self.song_list)
+        self.conn = connect()
         self.c = self.conn.cursor()
-        self._init_db()
+        self.store = ScoreStore(self.conn)
+
+    def _start(self, friend_manager: FriendManager):
+        self.friend_manager = friend_manager
+        self.launcher = WorkerLauncher(self.song_list, self.difficulty_rating, self.webapi, self.friend_manager)
+        self.scheduler = None
+        if REFRESH_INTERVAL > 0:
+            self.scheduler = RefreshScheduler(self.launcher, self.friend_manager, REFRESH_INTERVAL)
+            self.scheduler.start()
         atexit.register(self._exit)
 
     def _exit(self):
-        self.friend_manager.save_mapping()
-
-    def _init_db(self):
-        self.c.execute('''
-        CREATE TABLE IF NOT EXISTS user(
-        id TEXT PRIMARY KEY NOT NULL,
-        user_id INTEGER NOT NULL,
-        user_code TEXT NOT NULL
-        )''')
-        self.conn.commit()
+        if self.scheduler is not None:
+            self.scheduler.stop()
 
     def login(self, username, password):
         response = self.webapi.login(username, password)
@@ -43,6 +83,27 @@ class ArcOnlineHelper:
         ans = await self.launcher.start_task(user_id, work_type, **kwargs)
         return ans
 
+    async def sweep(self, max_age: float = 0):
+        """
+        refreshes the scores of every tracked friend with one request per chart. later b30 requests
+        skip the charts a sweep already covered, unless the friend played after it.
+        :param max_age: charts swept less than max_age seconds ago are skipped
+        :return: number of swept charts
+        """
+        return await self.launcher.start_sweep(max_age)
+
+    async def update_ratings(self):
+        """
+        updates the chart constants (see DifficultyRatingList.update_via_wikiwiki) and recomputes
+        the potentials of every stored score with them.
+        :return: number of scores whose rating or potential changed
+        """
+        await self.difficulty_rating.update_via_wikiwiki()
+        updated = self.store.recompute_potentials(self.difficulty_rating.constants())
+        if updated:
+            RESULT_CACHE.invalidate()
+        return updated
+
     async def add_friend(self, friend_code: str, identifier: str = ''):
         friend_id = await self.friend_manager.add_friend(friend_code)
         if identifier == '':
@@ -52,3 +113,69 @@ class ArcOnlineHelper:
         ''', (identifier, friend_id, friend_code))
         self.conn.commit()
         return identifier
+
+    async def iter_scores(self, name: str, **filters):
+        """
+        async generator over every stored score of a friend as dicts, best potential first.
+        rows are read from the database in small batches in an executor, never all at once.
+        :param filters: difficulty, min_rating, max_rating, played_after (see ScoreStore.iter_scores)
+        """
+        user_id = await self.friend_manager.get_friend_id(name)
+        loop = asyncio.get_running_loop()
+        rows = self.store.iter_scores(user_id, **filters)
+        # held while a batch is read, a cancelled await leaves the read running in the executor
+        lock = threading.Lock()
+        try:
+            while True:
+                batch = await loop.run_in_executor(None, self._next_batch, rows, 200, lock)
+                if not batch:
+                    return
+                for row in self.store.to_dicts(batch):
+                    yield row
+        finally:
+            # closed in the executor once the batch in flight (if any) is done, without waiting for it here
+            loop.run_in_executor(None, self._close_rows, rows, lock)
+
+    @staticmethod
+    def _next_batch(rows, size: int, lock: threading.Lock):
+        batch = []
+        with lock:
+            for row in rows:
+                batch.append(row)
+                if len(batch) == size:
+                    break
+        return batch
+
+    @staticmethod
+    def _close_rows(rows, lock: threading.Lock):
+        with lock:
+            rows.close()
+
+    async def iter_scores_ndjson(self, name: str, **filters):
+        """
+        stored scores of a friend as newline delimited json, one score per line.
+        the name is resolved before anything is read, so an unknown friend raises here and not halfway
+        through a response. the returned generator is meant to be handed to a streaming http response as is.
+        :param filters: difficulty, min_rating, max_rating, played_after (see ScoreStore.iter_scores)
+        :raises FriendNotFoundError: if name is not a friend
+        """
+        user_id = await self.friend_manager.get_friend_id(name)
+        return self._ndjson_lines(self.store.iter_scores(user_id, **filters))
+
+    @staticmethod
+    def _ndjson_lines(rows):
+        for row in rows:
+            yield json.dumps(dict(zip(SCORE_COLUMNS, row)), ensure_ascii=False) + '\n'
+
+    async def pin_friend(self, name: str, pinned: bool = True):
+        """
+        pins a friend, so their friend slot is never freed for another friend.
+        """
+        user_id = await self.friend_manager.get_friend_id(name)
+        self.friend_manager.pin(user_id, pinned)
+
+    def rate_limit_status(self):
+        """
+        returns the current request rate and the number of callers waiting on the shared rate limiter.
+        """
+        return self.webapi.limiter.status()
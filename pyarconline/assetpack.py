@@ -0,0 +1,126 @@
+import json
+import mmap
+import os
+import struct
+
+from .config import ASSET_PACK_PATH, SONG_PATH, CHARACTER_PATH, DIAMOND_PATH, GRADE_PATH, DIFF_PATH, \
+    CHIERI_TABLE_PATH, CHIERI_MASK_PATH
+
+MAGIC = b'PYARCPK1'
+_HEADER = struct.Struct('<8sQQ')
+_ALIGNMENT = 64
+_BANDS = {'RGBA': 4, 'L': 1}
+
+
+def pack_key(path: str, mode: str, size: tuple[int, int] = None) -> str:
+    size = '' if size is None else f'{size[0]}x{size[1]}'
+    return f'{os.path.normpath(path)}|{mode}|{size}'
+
+
+def asset_entries():
+    """
+    (path, mode, size) of every image the renderer loads, at the size it is drawn at.
+    """
+    for name in sorted(os.listdir(SONG_PATH)):
+        yield os.path.join(SONG_PATH, name), 'RGBA', (241, 241)
+    for name in sorted(os.listdir(CHARACTER_PATH)):
+        yield os.path.join(CHARACTER_PATH, name), 'RGBA', (684, 684)
+    for name in sorted(os.listdir(DIAMOND_PATH)):
+        yield os.path.join(DIAMOND_PATH, name), 'RGBA', (357, 357)
+    for name in sorted(os.listdir(GRADE_PATH)):
+        yield os.path.join(GRADE_PATH, name), 'RGBA', (110, 53)
+    for name in sorted(os.listdir(DIFF_PATH)):
+        yield os.path.join(DIFF_PATH, name), 'RGBA', None
+    yield CHIERI_TABLE_PATH, 'RGBA', None
+    yield CHIERI_MASK_PATH, 'L', None
+
+
+def build_asset_pack(path: str = ASSET_PACK_PATH):
+    """
+    decodes and resizes every renderer asset once and writes them as raw pixels into a single pack file:
+    a header (magic, index size, data offset), a json index (key -> offset in the data, width, height, mode,
+    source mtime) and the pixel data, every image aligned to 64 bytes.
+    :return: number of packed images
+    """
+    from .cache import AssetCache
+
+    index = {}
+    tmp_path = path + '.tmp'
+    data_path = path + '.data.tmp'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the index has to precede the pixel data but is only complete at the end
+    with open(data_path, 'w+b') as data:
+        for curr_path, mode, size in asset_entries():
+            img = AssetCache._load(curr_path, mode, size)
+            data.write(b'\0' * (-data.tell() % _ALIGNMENT))
+            index[pack_key(curr_path, mode, size)] = (data.tell(), img.width, img.height, mode,
+                                                      os.path.getmtime(curr_path))
+            data.write(img.tobytes())
+        header = json.dumps(index).encode('UTF-8')
+        data_offset = _HEADER.size + len(header)
+        data_offset += -data_offset % _ALIGNMENT
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, len(header), data_offset))
+            f.write(header)
+            f.write(b'\0' * (data_offset - f.tell()))
+            data.seek(0)
+            while chunk := data.read(1 << 20):
+                f.write(chunk)
+    os.remove(data_path)
+    os.replace(tmp_path, path)
+    return len(index)
+
+
+class AssetPack:
+    """
+    Read-only view of an asset pack built by build_asset_pack.
+
+    The file is memory-mapped and images are created on top of the mapping without copying, so every
+    process rendering from the same pack shares one page-cached copy of the pixels. Entries whose source
+    file changed after the pack was built are ignored.
+    """
+
+    def __init__(self, path: str = ASSET_PACK_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size, self.data_offset = _HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an asset pack')
+        index = json.loads(self.mmap[_HEADER.size:_HEADER.size + header_size])
+        self.index = {key: entry for key, entry in index.items() if self._is_fresh(key, entry)}
+
+    @staticmethod
+    def _is_fresh(key: str, entry) -> bool:
+        source = key.split('|', 1)[0]
+        return os.path.exists(source) and os.path.getmtime(source) == entry[4]
+
+    @classmethod
+    def open(cls, path: str = ASSET_PACK_PATH):
+        """
+        :return: the pack at path, None if there is no (valid) pack
+        """
+        try:
+            return cls(path)
+        except (FileNotFoundError, ValueError, struct.error):
+            return None
+
+    def __contains__(self, key: str):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def image(self, path: str, mode: str, size: tuple[int, int] = None):
+        """
+        :return: the packed image (read-only, shares memory with the pack), None if it is not packed
+        """
+        entry = self.index.get(pack_key(path, mode, size))
+        if entry is None:
+            return None
+        from PIL import Image
+
+        offset, width, height, mode, _ = entry
+        offset += self.data_offset
+        pixels = memoryview(self.mmap)[offset:offset + width * height * _BANDS[mode]]
+        return Image.frombuffer(mode, (width, height), pixels, 'raw', mode, 0, 1)
@@ -0,0 +1,151 @@
+import asyncio
+import weakref
+from typing import TYPE_CHECKING
+
+from .config import WEBAPI_BASE_URL, WEBAPI_POOL_SIZE, USER_AGENT
+from .ratelimiter import RateLimiter, DEFAULT_LIMITER
+from .utils import WebapiUtils
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+class AsyncWebapiUtils:
+    """
+    asyncio counterpart of WebapiUtils, with the same method surface.
+
+    Every event loop gets its own aiohttp session on top of a bounded keep-alive connection
+    pool (pool_size connections at most), so hundreds of requests can be awaited concurrently
+    without opening hundreds of sockets. Pass base_url to point the client at a local stub server.
+    ArcOnlineHelper does not use it itself, async callers can share its session with from_sync(helper.webapi).
+
+    Note: just like WebapiUtils, this class does not validate anything it sends.
+    """
+
+    def __init__(self, base_url: str = WEBAPI_BASE_URL, pool_size: int = WEBAPI_POOL_SIZE,
+                 cookies: dict = None, timeout: float = 30, limiter: RateLimiter = DEFAULT_LIMITER, retries: int = 3):
+        self.base_url = base_url.rstrip('/')
+        self.limiter = limiter
+        self.retries = retries
+        self.pool_size = pool_size
+        self.cookies = dict(cookies) if cookies else {}
+        self.timeout = timeout
+        self._sessions = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_sync(cls, webapi: WebapiUtils, **kwargs):
+        """
+        creates a client sharing the login state and the rate limiter of a (logged in) WebapiUtils.
+        """
+        return cls(base_url=webapi.base_url, cookies=webapi.get_cookies(), limiter=webapi.limiter, **kwargs)
+
+    async def _session(self) -> 'aiohttp.ClientSession':
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            # aiohttp takes longer to import than the rest of the package, only load it once it is used
+            import aiohttp
+            from yarl import URL
+
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': USER_AGENT},
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                            cookie_jar=aiohttp.CookieJar(unsafe=True))
+            if self.cookies:
+                session.cookie_jar.update_cookies(self.cookies, URL(self.base_url))
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        """
+        closes the session (and its connection pool) of the running event loop.
+        """
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _request(self, method: str, path: str, **kwargs):
+        session = await self._session()
+        await self.limiter.acquire_async()
+        async with session.request(method, self.base_url + path, **kwargs) as response:
+            for name, morsel in response.cookies.items():
+                self.cookies[name] = morsel.value
+            try:
+                content = await response.json(content_type=None)
+            except ValueError:
+                content = {'success': False, 'status_code': response.status}
+            self.limiter.feedback(response.status, RateLimiter.parse_retry_after(response.headers.get('Retry-After')))
+            return response.status, content
+
+    async def _get(self, path: str):
+        for _ in range(self.retries):
+            status_code, content = await self._request('GET', path)
+            if status_code != 429 and status_code < 500:
+                break
+        return content
+
+    async def _post(self, path: str, **kwargs):
+        return (await self._request('POST', path, **kwargs))[1]
+
+    async def authenticate(self):
+        return await self._get('/auth/me')
+
+    async def userinfo(self):
+        return await self._get('/webapi/user/me')
+
+    async def clear_statistic(self, difficulty: int):
+        return await self._get(f'/webapi/user/me/clear_statistic?difficulty={difficulty}')
+
+    async def add_friend(self, friend_code: str):
+        headers, data = WebapiUtils.create_form_data('friend_code', friend_code)
+        return await self._post('/webapi/friend/me/add', data=data, headers=headers)
+
+    async def delete_friend(self, friend_id: str):
+        headers, data = WebapiUtils.create_form_data('friend_id', friend_id)
+        return await self._post('/webapi/friend/me/delete', data=data, headers=headers)
+
+    async def login(self, email: str, password: str):
+        data = {'email': email, 'password': password}
+        return await self._post('/auth/login', json=data)
+
+    async def logout(self):
+        data = {}
+        return await self._post('/auth/logout', json=data)
+
+    async def my_score(self, difficulty: int, page: int, sort: str, term: str = ""):
+        """
+        returns your score. you should subscribe arcaea online before using this function
+        :param difficulty: 0-3
+        :param page: 1-count/10+1
+        :param sort: score,date,score_below_max,title
+        :param term: search term
+        :return: response
+        """
+        return await self._get(
+            f'/webapi/score/song/me/all?difficulty={difficulty}&page={page}&sort={sort}&term={term}')
+
+    async def world_rank_score(self, song_id: str, difficulty: int, limit: int = 20):
+        return await self._get(f'/webapi/score/song?song_id={song_id}&difficulty={difficulty}&limit={limit}')
+
+    async def friend_rank_score(self, song_id: str, difficulty: int, limit: int = 30):
+        return await self._get(f'/webapi/score/song/friend?song_id={song_id}&difficulty={difficulty}&limit={limit}')
+
+    async def my_rating(self):
+        return await self._get('/webapi/score/rating/me')
+
+    async def my_rating_progression(self, duration: str):
+        """
+        returns your rating progression, you should subscribe arcaea online before using this function
+        :param duration: w,m,y,3y,5y
+        :return: response
+        """
+        return await self._get(f'/webapi/score/rating_progression/me?duration={duration}')
+
+    async def get_apk_url(self):
+        return await self._get('/webapi/serve/static/bin/arcaea/apk')
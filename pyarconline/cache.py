@@ -0,0 +1,351 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+from typing import TYPE_CHECKING
+
+from .config import ASSET_CACHE_SIZE, CHIERI_BG_PATH, CHIERI_MASK_PATH, CHIERI_TABLE_PATH, DIFF_PATH, GRADE_PATH, \
+    DIAMOND_PATH, SONG_PATH, COVER_COLOR_INDEX_PATH, TILE_CACHE_SIZE, TILE_CACHE_PATH, TILE_CACHE_ON_DISK, \
+    RESULT_CACHE_MB, RESULT_ENCODINGS, ASSET_PACK_PATH
+from .assetpack import AssetPack
+
+if TYPE_CHECKING:
+    from PIL import Image, ImageFont
+
+
+class LRUCache:
+    """
+    thread-safe mapping that keeps at most maxsize entries, evicting the least recently used one.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        """
+        returns the cached value of key, calling factory() to create it on a miss.
+        """
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class AssetCache:
+    """
+    Decoded, pre-converted images and parsed fonts used by the renderer.
+
+    Images handed out by this cache are shared between all renders: never draw on them,
+    copy() them first if they have to be modified.
+    Images found in the asset pack (see assetpack.build_asset_pack) are read from it without decoding.
+    """
+
+    def __init__(self, maxsize: int = ASSET_CACHE_SIZE, cover_color_index_path: str = COVER_COLOR_INDEX_PATH,
+                 pack_path: str = ASSET_PACK_PATH):
+        self.images = LRUCache(maxsize)
+        self.pack_path = pack_path
+        self._pack = None
+        self.pack_lock = threading.Lock()
+        # FreeType faces must not be used by two threads at once, so every thread parses its own fonts
+        self.local = threading.local()
+        self.cover_color_index_path = cover_color_index_path
+        self.cover_colors = None
+
+    @property
+    def pack(self) -> AssetPack:
+        """the asset pack, opened on first use. False if there is none"""
+        if self._pack is None:
+            with self.pack_lock:
+                if self._pack is None:
+                    self._pack = AssetPack.open(self.pack_path) or False
+        return self._pack
+
+    def image(self, path: str, mode: str = 'RGBA', size: tuple[int, int] = None) -> 'Image.Image':
+        return self.images.get_or_create((path, mode, size), lambda: self._load_packed(path, mode, size))
+
+    def _load_packed(self, path: str, mode: str, size: tuple[int, int]):
+        img = self.pack.image(path, mode, size) if self.pack else None
+        return img if img is not None else self._load(path, mode, size)
+
+    @staticmethod
+    def _load(path: str, mode: str, size: tuple[int, int]):
+        from PIL import Image
+
+        with Image.open(path) as img:
+            img = img.convert(mode)
+        if size is not None:
+            img = img.resize(size)
+        return img
+
+    def font(self, path: str, size: int) -> 'ImageFont.FreeTypeFont':
+        from PIL import ImageFont
+
+        fonts = getattr(self.local, 'fonts', None)
+        if fonts is None:
+            fonts = self.local.fonts = {}
+        key = (path, size)
+        font = fonts.get(key)
+        if font is None:
+            font = fonts[key] = ImageFont.truetype(path, size)
+        return font
+
+    @staticmethod
+    def average_color(image: 'Image.Image'):
+        """
+        average color of the left fifth of an image, brightened by 20, used as the card background.
+        """
+        from PIL import ImageStat
+
+        width, height = image.size
+        stat = ImageStat.Stat(image.crop((0, 0, int(width / 5), height)))
+        r, g, b = stat.mean[:3]
+        return 20 + int(r), 20 + int(g), 20 + int(b)
+
+    def cover_color(self, cover_path: str):
+        """
+        average_color of a cover resized to 241x241, memoized per cover file
+        and read from the precomputed index if there is one.
+        """
+        if self.cover_colors is None:
+            self.cover_colors = self._load_cover_color_index()
+        name = os.path.basename(cover_path)
+        color = self.cover_colors.get(name)
+        if color is None:
+            color = self.average_color(self.image(cover_path, size=(241, 241)))
+            self.cover_colors[name] = color
+        return color
+
+    def _load_cover_color_index(self):
+        try:
+            with open(self.cover_color_index_path, 'r', encoding='UTF-8') as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        colors = {}
+        for name, item in index.items():
+            path = os.path.join(SONG_PATH, name)
+            # entries of replaced covers are dropped and recomputed on demand
+            if os.path.exists(path) and os.path.getmtime(path) == item['mtime']:
+                colors[name] = tuple(item['color'])
+        return colors
+
+    def build_cover_color_index(self):
+        """
+        computes the card background color of every cover in assets/songs and saves them
+        to the cover color index, so they never have to be computed at request time.
+        """
+        index = {}
+        colors = {}
+        for name in sorted(os.listdir(SONG_PATH)):
+            path = os.path.join(SONG_PATH, name)
+            color = self.average_color(self._load(path, 'RGBA', (241, 241)))
+            index[name] = {'mtime': os.path.getmtime(path), 'color': color}
+            colors[name] = color
+        os.makedirs(os.path.dirname(self.cover_color_index_path), exist_ok=True)
+        # written next to the index under a name of its own and swapped in, concurrent builds
+        # never share a temporary file and readers never see half a file
+        tmp_path = f'{self.cover_color_index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='UTF-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.cover_color_index_path)
+        except OSError as e:
+            print("could not write cover color index", self.cover_color_index_path, e)
+        self.cover_colors = colors
+        return colors
+
+    def ensure_cover_color_index(self):
+        """
+        builds the cover color index unless it already exists.
+        """
+        if not os.path.exists(self.cover_color_index_path):
+            self.build_cover_color_index()
+
+    def warm_up(self, build_index: bool = True):
+        """
+        loads everything every b30 needs (background, table, mask, diffs, grades, diamonds and
+        the cover color index) so the first request does not pay for decoding them.
+        fonts are per thread and get parsed by the first render of every thread.
+        :param build_index: build the cover color index if it does not exist yet, otherwise it is only loaded
+        """
+        self.image(CHIERI_BG_PATH)
+        self.image(CHIERI_TABLE_PATH)
+        self.image(CHIERI_MASK_PATH, 'L')
+        for name in sorted(os.listdir(DIFF_PATH)):
+            self.image(os.path.join(DIFF_PATH, name))
+        for name in sorted(os.listdir(GRADE_PATH)):
+            self.image(os.path.join(GRADE_PATH, name), size=(110, 53))
+        for name in sorted(os.listdir(DIAMOND_PATH)):
+            self.image(os.path.join(DIAMOND_PATH, name), size=(357, 357))
+        if build_index and not os.path.exists(self.cover_color_index_path):
+            try:
+                self.build_cover_color_index()
+            except Exception as e:
+                # colors are then computed on demand
+                print("building the cover color index failed:", e)
+        if self.cover_colors is None:
+            self.cover_colors = self._load_cover_color_index()
+
+    def clear(self):
+        self.images.clear()
+        self.local.fonts = {}
+        self._pack = None
+
+
+class TileCache:
+    """
+    Content-addressed cache of rendered b30 cards.
+
+    A card only depends on the fields it is keyed by, so a cached one can be reused by any later render
+    of the same score. Cards are kept in memory (LRU) and, if directory is given, as png files on disk.
+    """
+
+    def __init__(self, maxsize: int = TILE_CACHE_SIZE, directory: str = None):
+        self.tiles = LRUCache(maxsize)
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*fields) -> str:
+        return hashlib.sha1(repr(fields).encode('UTF-8')).hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, key + '.png')
+
+    def get(self, key: str):
+        tile = self.tiles.get(key)
+        if tile is None and self.directory is not None:
+            from PIL import Image
+
+            try:
+                with Image.open(self._path(key)) as img:
+                    tile = img.convert('RGBA')
+            except (FileNotFoundError, OSError):
+                return None
+            self.tiles.put(key, tile)
+        return tile
+
+    def put(self, key: str, tile: 'Image.Image'):
+        self.tiles.put(key, tile)
+        if self.directory is not None:
+            # write to a temporary name first, concurrent readers must never see half a file
+            tmp_path = self._path(key) + f'.{threading.get_ident()}.tmp'
+            tile.save(tmp_path, format='PNG', compress_level=1)
+            os.replace(tmp_path, self._path(key))
+
+    def clear(self):
+        self.tiles.clear()
+
+
+class ResultCache:
+    """
+    Last rendered b30 of every user, encoded with the (at most encodings) sets of options it was
+    last requested with, together with the fingerprint of everything drawn on it.
+
+    As long as the fingerprint of a new request matches, the stored result can be returned as is.
+    The cache is bounded by the total size of the stored results (max_bytes): a full b30 is about 6 MB
+    as png and 2 MB as webp, so once it is full the least recently used encodings are dropped first.
+    """
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_MB << 20, encodings: int = RESULT_ENCODINGS):
+        self.max_bytes = max_bytes
+        self.encodings = encodings
+        # user_id -> (fingerprint, options -> result), both least recently used first
+        self.results = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(rows, *fields) -> str:
+        # time_stamp (column 5) only records when a row was last fetched, the image does not show it
+        scores = tuple(row[:5] + row[6:] for row in rows)
+        return TileCache.key(scores, *fields)
+
+    @staticmethod
+    def _size(result) -> int:
+        return len(result) if isinstance(result, (bytes, bytearray)) else 0
+
+    def get(self, user_id: int, fingerprint: str, options: tuple = None):
+        with self.lock:
+            entry = self.results.get(user_id)
+            if entry is None or entry[0] != fingerprint or options not in entry[1]:
+                return None
+            self.results.move_to_end(user_id)
+            entry[1].move_to_end(options)
+            return entry[1][options]
+
+    def put(self, user_id: int, fingerprint: str, result, options: tuple = None):
+        size = self._size(result)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            entry = self.results.get(user_id)
+            if entry is None or entry[0] != fingerprint:
+                # a new fingerprint makes every encoding of the old image stale
+                self._drop(user_id)
+                entry = self.results[user_id] = (fingerprint, collections.OrderedDict())
+            encodings = entry[1]
+            if options in encodings:
+                self.size -= self._size(encodings.pop(options))
+            encodings[options] = result
+            self.size += size
+            self.results.move_to_end(user_id)
+            while len(encodings) > self.encodings:
+                self.size -= self._size(encodings.popitem(last=False)[1])
+            while self.size > self.max_bytes:
+                oldest_id, (_, oldest) = next(iter(self.results.items()))
+                self.size -= self._size(oldest.popitem(last=False)[1])
+                if not oldest:
+                    del self.results[oldest_id]
+
+    def _drop(self, user_id: int):
+        entry = self.results.pop(user_id, None)
+        if entry is not None:
+            self.size -= sum(self._size(result) for result in entry[1].values())
+
+    def invalidate(self, user_id: int = None):
+        with self.lock:
+            if user_id is None:
+                self.results.clear()
+                self.size = 0
+            else:
+                self._drop(user_id)
+
+
+ASSET_CACHE = AssetCache()
+TILE_CACHE = TileCache(directory=TILE_CACHE_PATH if TILE_CACHE_ON_DISK else None)
+RESULT_CACHE = ResultCache()
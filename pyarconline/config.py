@@ -1,4 +1,5 @@
 import configparser
+import functools
 import os.path
 
 config = configparser.ConfigParser()
@@ -7,6 +8,30 @@ config.read('config.ini')
 SAVE_PATH = config.get('DEFAULT', 'SAVE_PATH')
 IMG_SAVE_PATH = config.get('DEFAULT', 'IMG_SAVE_PATH')
 ASSETS_PATH = config.get('DEFAULT', 'ASSETS_PATH')
+QUERY_WORKERS = config.getint('DEFAULT', 'QUERY_WORKERS', fallback=2)
+QUERY_CONCURRENCY = config.getint('DEFAULT', 'QUERY_CONCURRENCY', fallback=8)
+RENDER_PROCESSES = config.getint('DEFAULT', 'RENDER_PROCESSES', fallback=0)
+CARD_WORKERS = config.getint('DEFAULT', 'CARD_WORKERS', fallback=4)
+WEBAPI_BASE_URL = config.get('DEFAULT', 'WEBAPI_BASE_URL', fallback='https://webapi.lowiro.com')
+WEBAPI_POOL_SIZE = config.getint('DEFAULT', 'WEBAPI_POOL_SIZE', fallback=16)
+RATE_LIMIT = config.getfloat('DEFAULT', 'RATE_LIMIT', fallback=2.0)
+MIN_RATE_LIMIT = config.getfloat('DEFAULT', 'MIN_RATE_LIMIT', fallback=0.2)
+MAX_RATE_LIMIT = config.getfloat('DEFAULT', 'MAX_RATE_LIMIT', fallback=10.0)
+SCORE_BATCH_SIZE = config.getint('DEFAULT', 'SCORE_BATCH_SIZE', fallback=500)
+ASSET_CACHE_SIZE = config.getint('DEFAULT', 'ASSET_CACHE_SIZE', fallback=256)
+WARM_UP_ASSETS = config.getboolean('DEFAULT', 'WARM_UP_ASSETS', fallback=True)
+TILE_CACHE_SIZE = config.getint('DEFAULT', 'TILE_CACHE_SIZE', fallback=256)
+TILE_CACHE_ON_DISK = config.getboolean('DEFAULT', 'TILE_CACHE_ON_DISK', fallback=False)
+RESULT_CACHE_MB = config.getint('DEFAULT', 'RESULT_CACHE_MB', fallback=128)
+RESULT_ENCODINGS = config.getint('DEFAULT', 'RESULT_ENCODINGS', fallback=4)
+REFRESH_INTERVAL = config.getfloat('DEFAULT', 'REFRESH_INTERVAL', fallback=60)
+MIN_PLAY_INTERVAL = config.getfloat('DEFAULT', 'MIN_PLAY_INTERVAL', fallback=60)
+USERINFO_TTL = config.getfloat('DEFAULT', 'USERINFO_TTL', fallback=5)
+FRIEND_SLOT_RESERVE = config.getint('DEFAULT', 'FRIEND_SLOT_RESERVE', fallback=1)
+IMAGE_FORMAT = config.get('DEFAULT', 'IMAGE_FORMAT', fallback='png')
+IMAGE_QUALITY = config.getint('DEFAULT', 'IMAGE_QUALITY', fallback=85)
+PNG_COMPRESS_LEVEL = config.getint('DEFAULT', 'PNG_COMPRESS_LEVEL', fallback=1)
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
 
 FRIEND_LIST_PATH = os.path.join(SAVE_PATH, 'friendlist.json')
 RATINGS_PATH = os.path.join(SAVE_PATH, 'ratings.json')
@@ -32,12 +57,18 @@ Roboto_Light_PATH = os.path.join(FONT_PATH, "Roboto-Light.ttf")
 Exo_Regular_PATH = os.path.join(FONT_PATH, "Exo-Regular.ttf")
 OpenSans_Regular_PATH = os.path.join(FONT_PATH, "OpenSans-Regular.ttf")
 DB_PATH = os.path.join(SAVE_PATH, 'b30data.db')
+COVER_COLOR_INDEX_PATH = os.path.join(SAVE_PATH, 'cover_colors.json')
+TILE_CACHE_PATH = os.path.join(IMG_SAVE_PATH, 'tiles')
+ASSET_PACK_PATH = os.path.join(SAVE_PATH, 'assets.pack')
+SONGLIST_CACHE_PATH = os.path.join(SAVE_PATH, 'songlist.cache')
+RATINGS_CACHE_PATH = os.path.join(SAVE_PATH, 'ratings.cache')
 
 
 def get_diamond_path(n: str):
     return os.path.join(DIAMOND_PATH, f"rating_{n}.png")
 
 
+@functools.lru_cache(maxsize=None)
 def get_cover_path(id: str, difficulty: int):
     cover_path = os.path.join(SONG_PATH, f"{id}_{str(difficulty)}.jpg")
     if not os.path.exists(cover_path):
@@ -0,0 +1,37 @@
+import os
+import pickle
+
+# bump whenever the layout of compiled data changes, older caches are then rebuilt
+CACHE_FORMAT = 1
+
+
+def source_key(source_path: str) -> tuple:
+    stat = os.stat(source_path)
+    return CACHE_FORMAT, os.path.abspath(source_path), stat.st_mtime_ns, stat.st_size
+
+
+def load_compiled(source_path: str, cache_path: str, compile_source):
+    """
+    returns compile_source(source_path), read from the pickle at cache_path if it was compiled
+    from the current version of the source file (same path, mtime and size), recompiled and saved otherwise.
+    the cache is only an optimization: an unreadable or unwritable cache file is ignored.
+    """
+    key = source_key(source_path)
+    try:
+        with open(cache_path, 'rb') as f:
+            if pickle.load(f) == key:
+                return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print("ignoring unreadable cache", cache_path, e)
+    data = compile_source(source_path)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print("could not write cache", cache_path, e)
+    return data
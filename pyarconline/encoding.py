@@ -0,0 +1,40 @@
+from .config import IMAGE_FORMAT, IMAGE_QUALITY, PNG_COMPRESS_LEVEL
+
+MIME_TYPES = {'png': 'image/png', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+# preview widths are rounded up to one of these, so clients cannot create an encoding per pixel.
+# all of them are below the width of the b30 canvas (1800, assets/b30/chieri/bg.png)
+PREVIEW_WIDTHS = (300, 600, 900, 1200)
+
+
+def encoding_options(image_format: str = IMAGE_FORMAT, quality: int = None, compress_level: int = None,
+                     preview_width: int = None) -> tuple:
+    """
+    validates and completes encoding options. the result is hashable, so it can be used as a cache key.
+    :param image_format: png, webp or jpeg
+    :param quality: webp/jpeg quality, 1-100
+    :param compress_level: png compression level, 0 (fastest) - 9 (smallest)
+    :param preview_width: if given, the image is downscaled to the next width in PREVIEW_WIDTHS,
+        wider previews are full-size images
+    :raises ValueError: if an option is out of range
+    """
+    image_format = (image_format or IMAGE_FORMAT).lower()
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+    if image_format not in MIME_TYPES:
+        raise ValueError(f'Unknown image format {image_format}')
+    if image_format == 'png':
+        quality = None
+        compress_level = PNG_COMPRESS_LEVEL if compress_level is None else int(compress_level)
+        if not 0 <= compress_level <= 9:
+            raise ValueError(f'compress_level must be between 0 and 9, not {compress_level}')
+    else:
+        compress_level = None
+        quality = IMAGE_QUALITY if quality is None else int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError(f'quality must be between 1 and 100, not {quality}')
+    if preview_width is not None:
+        preview_width = int(preview_width)
+        if preview_width <= 0:
+            raise ValueError(f'preview_width must be positive, not {preview_width}')
+        preview_width = next((width for width in PREVIEW_WIDTHS if width >= preview_width), None)
+    return image_format, quality, compress_level, preview_width
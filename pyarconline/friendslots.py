@@ -0,0 +1,125 @@
+import heapq
+import json
+import sqlite3
+import threading
+import time
+
+from .config import FRIEND_LIST_PATH
+from .storage import connect
+
+
+class FriendSlots:
+    """
+    Last use of every friend occupying a friend slot, persisted row by row in the friend_slot table.
+
+    The least recently used unpinned friend is found through a heap with lazy deletion: touching a friend
+    pushes a new entry, outdated entries are dropped when they reach the top. Once more than half of the
+    heap is outdated it is rebuilt from last_used, so it never holds more than 2n entries and every
+    operation is O(log n) amortized.
+    """
+
+    def __init__(self, conn: sqlite3.Connection = None, legacy_path: str = FRIEND_LIST_PATH):
+        self.conn = conn if conn is not None else connect()
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.pinned = set()
+        self.heap = []
+        with self.lock:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS friend_slot (
+                friend_id INTEGER PRIMARY KEY NOT NULL,
+                last_used REAL NOT NULL,
+                pinned INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            self.migrate(legacy_path)
+            rows = self.conn.execute('SELECT friend_id, last_used, pinned FROM friend_slot').fetchall()
+            for friend_id, last_used, pinned in rows:
+                self.last_used[friend_id] = last_used
+                if pinned:
+                    self.pinned.add(friend_id)
+            self.heap = [(last_used, friend_id) for friend_id, last_used in self.last_used.items()]
+            heapq.heapify(self.heap)
+
+    def migrate(self, legacy_path: str):
+        """
+        imports the recent_use entries of the old friendlist.json, if the friend_slot table is still empty.
+        """
+        if self.conn.execute('SELECT 1 FROM friend_slot LIMIT 1').fetchone() is not None:
+            return
+        try:
+            with open(legacy_path, 'r') as f:
+                content = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.conn.executemany('INSERT OR IGNORE INTO friend_slot (friend_id, last_used) VALUES (?, ?)',
+                              [(item['friend_id'], item['recent_use']) for item in content])
+        self.conn.commit()
+
+    def __len__(self):
+        return len(self.last_used)
+
+    def __contains__(self, friend_id: int):
+        return friend_id in self.last_used
+
+    def get(self, friend_id: int, default=None):
+        """
+        :return: when the friend was last used, default if the friend has no slot
+        """
+        return self.last_used.get(friend_id, default)
+
+    def touch(self, friend_id: int, when: float = None):
+        when = time.time() if when is None else when
+        with self.lock:
+            self.last_used[friend_id] = when
+            if len(self.heap) >= 2 * len(self.last_used):
+                # outdated entries only leave the heap in least_used(), which may never run
+                self.heap = [(last_used, curr_id) for curr_id, last_used in self.last_used.items()]
+                heapq.heapify(self.heap)
+            else:
+                heapq.heappush(self.heap, (when, friend_id))
+            self.conn.execute('''
+            INSERT INTO friend_slot (friend_id, last_used) VALUES (?, ?)
+            ON CONFLICT (friend_id) DO UPDATE SET last_used=excluded.last_used
+            ''', (friend_id, when))
+            self.conn.commit()
+
+    def pin(self, friend_id: int, pinned: bool = True):
+        """
+        pinned friends are never chosen by least_used().
+        """
+        with self.lock:
+            if pinned:
+                self.pinned.add(friend_id)
+            else:
+                self.pinned.discard(friend_id)
+            self.conn.execute('UPDATE friend_slot SET pinned = ? WHERE friend_id = ?', (int(pinned), friend_id))
+            self.conn.commit()
+
+    def remove(self, friend_id: int):
+        with self.lock:
+            self.last_used.pop(friend_id, None)
+            self.pinned.discard(friend_id)
+            self.conn.execute('DELETE FROM friend_slot WHERE friend_id = ?', (friend_id,))
+            self.conn.commit()
+
+    def least_used(self):
+        """
+        :return: the least recently used unpinned friend, None if there is none
+        """
+        with self.lock:
+            skipped = []
+            friend_id = None
+            while self.heap:
+                when, curr_id = self.heap[0]
+                if self.last_used.get(curr_id) != when:
+                    heapq.heappop(self.heap)
+                elif curr_id in self.pinned:
+                    # still valid, put back once the search is over
+                    skipped.append(heapq.heappop(self.heap))
+                else:
+                    friend_id = curr_id
+                    break
+            for item in skipped:
+                heapq.heappush(self.heap, item)
+            return friend_id
@@ -0,0 +1,83 @@
+import heapq
+
+from .utils import count_potential
+
+
+class B30Planner:
+    """
+    Decides which charts have to be fetched to know the b30 of one user.
+
+    Every chart gets bounds on the user's current potential:
+
+    - lower bound: the stored score, since scores never decrease (none if there is no stored score)
+    - upper bound: the stored potential if the row is up to date (fetched or checked after the user
+      last played, with the current chart constant) or the stored score is already 10,000,000 or more,
+      nothing if a check after the user last played found no score, rating + 2.0 otherwise
+
+    A chart only has to be fetched if its upper bound beats the size-th best lower bound, and that
+    threshold only grows as fetched results come in. Candidates are handed out highest upper bound first,
+    so the plan ends as soon as the next candidate cannot enter the top size any more.
+    """
+
+    def __init__(self, charts, rows_dict: dict, last_active: int, checks: dict = None, size: int = 33,
+                 values=None):
+        """
+        :param charts: rating entries of all charts, sorted by rating (highest first)
+        :param rows_dict: stored score rows of the user, by (idx, difficulty)
+        :param last_active: time_played of the user's most recent play
+        :param checks: when each chart of the user was last checked (see ScoreStore.get_checks)
+        :param values: numeric constants of charts, in the same order, parsed from the entries if not given
+        """
+        checks = checks or {}
+        if values is None:
+            values = [float(chart['rating']) for chart in charts]
+        self.size = size
+        self.lower = {}
+        self.candidates = []
+        for chart, value in zip(charts, values):
+            key = (chart['idx'], chart['difficulty'])
+            row = rows_dict.get(key)
+            upper = value + 2.0
+            checked_at = checks.get(key, 0)
+            if row is not None:
+                up_to_date = row[3] == chart['rating']
+                self.lower[key] = row[8] if up_to_date else count_potential(row[6], chart['rating'])
+                if up_to_date and (last_active <= max(row[5], checked_at) or row[6] >= 10000000):
+                    continue
+            elif last_active <= checked_at:
+                continue
+            self.candidates.append((upper, chart))
+        self.candidates.sort(key=lambda item: item[0], reverse=True)
+        self.fetched = 0
+        self._threshold = None
+
+    @property
+    def threshold(self) -> float:
+        """the size-th best lower bound, 0.0 while fewer charts have one"""
+        if self._threshold is None:
+            best = heapq.nlargest(self.size, self.lower.values())
+            self._threshold = best[-1] if len(best) == self.size else 0.0
+        return self._threshold
+
+    def charts_to_fetch(self):
+        """
+        generator of the charts to fetch. it is meant to be consumed lazily, interleaved with record(),
+        so every chart is checked against the threshold known at the time it is pulled.
+        """
+        for upper, chart in self.candidates:
+            if upper <= self.threshold:
+                print("break", upper, self.threshold, "fetched", self.fetched, "of", len(self.candidates))
+                return
+            self.fetched += 1
+            yield chart
+
+    def record(self, chart: dict, potential: float):
+        """
+        records the fetched potential of a chart (None if the user has no score on it).
+        """
+        if potential is None:
+            return
+        key = (chart['idx'], chart['difficulty'])
+        if self.lower.get(key) != potential:
+            self.lower[key] = potential
+            self._threshold = None
@@ -0,0 +1,31 @@
+def count_potential(score: int, rating: str):
+    real_rating = float(rating)
+    if score >= 10000000:
+        ans = real_rating + 2.0
+    elif score >= 9800000:
+        ans = real_rating + 1.0 + (score - 9800000) / 200000
+    else:
+        ans = max(0.0, real_rating + (score - 9500000) / 300000)
+    return round(ans, 5)
+
+
+def count_potentials(scores, ratings) -> list:
+    """
+    count_potential of whole sequences of scores and numeric chart constants, vectorized with NumPy
+    if it is installed. the results are identical to count_potential, down to the rounding.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return [count_potential(score, rating) for score, rating in zip(scores, ratings)]
+    scores = numpy.asarray(scores, dtype=numpy.float64)
+    ratings = numpy.asarray(ratings, dtype=numpy.float64)
+    ans = numpy.where(scores >= 10000000, ratings + 2.0,
+                      numpy.where(scores >= 9800000, ratings + 1.0 + (scores - 9800000) / 200000,
+                                  numpy.maximum(0.0, ratings + (scores - 9500000) / 300000)))
+    potentials = numpy.round(ans, 5)
+    # numpy.round scales by 10^5 first, which may break near-ties differently than round() does
+    scaled = ans * 100000
+    near_tie = numpy.flatnonzero(numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6)
+    potentials[near_tie] = [round(value, 5) for value in ans[near_tie].tolist()]
+    return potentials.tolist()
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+
+from .config import RATE_LIMIT, MIN_RATE_LIMIT, MAX_RATE_LIMIT
+
+
+class RateLimiter:
+    """
+    Token bucket whose refill rate adapts to what the server accepts.
+
+    Every request reserves one token; callers that run out of tokens sleep until their reservation
+    becomes due, so any number of threads or coroutines can share one limiter. The rate grows
+    additively after every accepted request (up to max_rate) and is halved on 429/5xx responses,
+    which also pause the bucket for a short back-off period. Responses with success=false are
+    ordinary errors (unknown friend code, ...), they do not slow the bucket down.
+    """
+
+    def __init__(self, rate: float = RATE_LIMIT, min_rate: float = MIN_RATE_LIMIT, max_rate: float = MAX_RATE_LIMIT,
+                 burst: int = 1, increase: float = 0.05):
+        self._rate = min(max(rate, min_rate), max_rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        """current allowed requests per second"""
+        return self._rate
+
+    @property
+    def queue_depth(self) -> int:
+        """number of callers currently waiting for a token"""
+        return self.waiting
+
+    def status(self) -> dict:
+        with self.lock:
+            return {'rate': self._rate, 'queue_depth': self.waiting, 'tokens': self.tokens,
+                    'paused_for': max(0.0, self.paused_until - time.monotonic())}
+
+    def _reserve(self) -> float:
+        """takes one token and returns how long the caller has to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self._rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = 0.0 if self.tokens >= 0 else -self.tokens / self._rate
+            delay = max(delay, self.paused_until - now)
+            if delay > 0:
+                self.waiting += 1
+            return delay
+
+    def _done_waiting(self):
+        with self.lock:
+            self.waiting -= 1
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            try:
+                time.sleep(delay)
+            finally:
+                self._done_waiting()
+
+    async def acquire_async(self):
+        delay = self._reserve()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._done_waiting()
+
+    def feedback(self, status_code: int, retry_after: float = None):
+        """
+        adjusts the rate after a request finished.
+        :param status_code: http status code of the response
+        :param retry_after: value of the Retry-After header in seconds, if any
+        """
+        rejected = status_code == 429 or status_code >= 500
+        with self.lock:
+            if rejected:
+                self._rate = max(self.min_rate, self._rate / 2)
+                pause = retry_after if retry_after is not None else 1 / self._rate
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            else:
+                self._rate = min(self.max_rate, self._rate + self.increase)
+
+    @staticmethod
+    def parse_retry_after(value) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+DEFAULT_LIMITER = RateLimiter()
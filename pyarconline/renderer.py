@@ -0,0 +1,307 @@
+import concurrent.futures
+import datetime
+import io
+import os
+
+from PIL import Image, ImageDraw
+
+from .config import CHARACTER_PATH, CHIERI_BG_PATH, CHIERI_MASK_PATH, get_diamond_path, SansSerifFLF_PATH, \
+    OpenSans_Regular_PATH, Roboto_Light_PATH, Exo_Regular_PATH, CHIERI_TABLE_PATH, get_cover_path, get_diff_path, \
+    get_grade_path, SONGLIST_PATH, CARD_WORKERS
+from .utils import SongList
+from .cache import ASSET_CACHE, TILE_CACHE
+from .encoding import MIME_TYPES, encoding_options
+
+
+class B30Renderer:
+    """
+    Draws b30 images from score rows (in the column order of storage.SCORE_COLUMNS).
+
+    The renderer does not touch the database, so it can run in any thread or in a worker process.
+    """
+
+    def __init__(self, song_list: SongList, card_workers: int = CARD_WORKERS):
+        self.song_list = song_list
+        self.card_workers = card_workers
+        self.card_pool = None
+        if card_workers > 1:
+            self.card_pool = concurrent.futures.ThreadPoolExecutor(card_workers, thread_name_prefix='card-renderer')
+
+    def draw_cards(self, rows, style='chieri'):
+        """
+        draws the cards of the given rows (rank 1 to len(rows)), concurrently if card_workers > 1.
+        cards do not depend on each other, so the result is the same as drawing them one by one.
+        :return: the cards, in rank order
+        """
+        if self.card_pool is None or len(rows) < 2:
+            return [self.draw_single_b30(row, i + 1, style) for i, row in enumerate(rows)]
+        return list(self.card_pool.map(lambda i: self.draw_single_b30(rows[i], i + 1, style), range(len(rows))))
+
+    def draw_b30(self, rows, user_name: str, user_code: str, rating: int,
+                 character_id: int,
+                 is_character_uncapped,
+                 style='chieri'):
+        if style == 'chieri':
+            # 1. create bg
+            ans = ASSET_CACHE.image(CHIERI_BG_PATH).copy()
+            # 2. draw b30
+            start_x = 108
+            start_y = 823
+            b30_sum = 0
+            b10_sum = 0
+            singles = self.draw_cards(rows[:33], style)
+            for i in range(min(30, len(rows))):
+                single = singles[i]
+                potential = rows[i][8]
+                b30_sum += potential
+                if i < 10:
+                    b10_sum += potential
+                ans.paste(single, (start_x + 542 * (i % 3), start_y + 314 * (i // 3)), single)
+            # 3. draw overflow
+            for i in range(30, min(33, len(rows))):
+                single = singles[i]
+                ans.paste(single, (start_x + 542 * (i % 3), 4010), single)
+            # 4. draw diamond
+            DIAMOND_PATH = get_diamond_path(self.get_diamond(rating))
+            diamond = ASSET_CACHE.image(DIAMOND_PATH, size=(357, 357))
+            ans.alpha_composite(diamond, (127, 136))
+            # 5. write user_name
+            SansSerifFLF = ASSET_CACHE.font(SansSerifFLF_PATH, 104)
+            draw = ImageDraw.Draw(ans)
+            draw.text((462, 209), user_name, (255, 255, 255), SansSerifFLF)
+            # 6. write user_code
+            SansSerifFLF = ASSET_CACHE.font(SansSerifFLF_PATH, 61)
+            draw.text((455, 326), self.user_code2str(user_code), (255, 255, 255), SansSerifFLF)
+            # 7. write rating
+            SansSerifFLF = ASSET_CACHE.font(SansSerifFLF_PATH, 90)
+            self.write_boarder(draw, (191, 270), self.rating2str(rating), (255, 255, 255), SansSerifFLF, (98, 8, 98))
+            # 8. write b30 and r10
+            b30 = b30_sum / 30
+            r10 = 4 * (rating / 100 - 0.75 * b30)
+            SansSerifFLF = ASSET_CACHE.font(SansSerifFLF_PATH, 77)
+            draw.text((450, 547), format(b30, ".3f"), (255, 255, 255), SansSerifFLF)
+            draw.text((450, 637), format(r10, ".3f"), (255, 255, 255), SansSerifFLF)
+            # 9. write max_b30
+            max_b30 = (b30_sum + b10_sum) / 40
+            SansSerifFLF = ASSET_CACHE.font(SansSerifFLF_PATH, 49)
+            draw.text((884, 648), format(max_b30, ".3f"), (255, 255, 255), SansSerifFLF)
+            # 10. draw character
+            char_name = str(character_id)
+            if is_character_uncapped:
+                char_name += 'u'
+            char_name += '.png'
+            char_path = os.path.join(CHARACTER_PATH, char_name)
+            if os.path.exists(char_path):
+                character = ASSET_CACHE.image(char_path, size=(684, 684))
+                ans.alpha_composite(character, (1154, 119))
+            return ans
+
+    def draw_single_b30(self, data_row, index: int, style='chieri'):
+        """
+        returns the card of one score row, reusing a cached card if the same score was drawn before.
+        the returned image may be shared, do not draw on it.
+        """
+        idx, difficulty, song_id, rating, play_time, _, score, _, potential = data_row
+        key = TILE_CACHE.key(style, index, idx, difficulty, song_id, rating, play_time, score, potential)
+        tile = TILE_CACHE.get(key)
+        if tile is None:
+            tile = self.render_single_b30(data_row, index, style)
+            TILE_CACHE.put(key, tile)
+        return tile
+
+    def render_single_b30(self, data_row, index: int, style='chieri'):
+        idx = data_row[0]  # example: 87
+        id = data_row[2]  # example: fractureray
+        difficulty = data_row[1]  # example: 2
+        score = data_row[6]
+        rating = data_row[3]
+        potential = data_row[8]
+        play_time = int(data_row[4] / 1000)
+        title = self.song_list.get_song_name(idx, difficulty == 3)
+        COVER_PATH = get_cover_path(id, difficulty)
+
+        if style == 'chieri':
+            # 1. cover process
+            cover = ASSET_CACHE.image(COVER_PATH, size=(241, 241))
+            avg_color = ASSET_CACHE.cover_color(COVER_PATH)
+            ans = Image.new('RGBA', (501, 241), avg_color)
+            cover = cover.copy()
+            cover.putalpha(self.get_cover_gradient())
+            ans.paste(cover, (260, 0), cover)
+            # 2. paste table
+            table = ASSET_CACHE.image(CHIERI_TABLE_PATH)
+            ans.paste(table, (0, 0), table)
+            # 3. paste diff
+            DIFF_PATH = get_diff_path(difficulty)
+            diff = ASSET_CACHE.image(DIFF_PATH)
+            ans.paste(diff, (18, 22), diff)
+            # 4. paste grade
+            GRADE_PATH = get_grade_path(self.get_grade(score))
+            grade = ASSET_CACHE.image(GRADE_PATH, size=(110, 53))
+            ans.paste(grade, (48, 157), grade)
+            # 5. write title
+            roboto_light = ASSET_CACHE.font(Roboto_Light_PATH, 37)
+            draw = ImageDraw.Draw(ans)
+            color = self.choose_text_color(avg_color)
+            draw.text((41, 21), title, fill=color, font=roboto_light)
+            # 6. write score
+            roboto_light = ASSET_CACHE.font(Roboto_Light_PATH, 51)
+            draw.text((37, 64), self.score2str(score), fill=color, font=roboto_light)
+            # 7. write rating
+            exo_regular = ASSET_CACHE.font(Exo_Regular_PATH, 23)
+            draw.text((213, 147), rating, fill=color, font=exo_regular)
+            # 8. write potential
+            exo_regular = ASSET_CACHE.font(Exo_Regular_PATH, 37)
+            draw.text((262, 128), '> ' + format(potential, ".2f"), fill=color, font=exo_regular)
+            # 9. write time
+            exo_regular = ASSET_CACHE.font(Exo_Regular_PATH, 21)
+            dt_object = datetime.datetime.fromtimestamp(play_time)
+            formatted_time = dt_object.strftime('%Y-%m-%d %H:%M:%S')
+            draw.text((213, 204), formatted_time, fill=color, font=exo_regular)
+            # 10. write index
+            opensans = ASSET_CACHE.font(OpenSans_Regular_PATH, 28)
+            shadow_color = (98, 8, 98)
+            text = '#' + str(index)
+            self.write_boarder(draw, (442, 202), text, (255, 255, 255), opensans, shadow_color)
+            # 11. apply mask
+            mask = ASSET_CACHE.image(CHIERI_MASK_PATH, 'L')
+            ans.putalpha(mask)
+            return ans
+
+    @staticmethod
+    def get_cover_gradient():
+        """alpha mask fading the left part of a 241x241 cover into the card background"""
+
+        def create():
+            gradient = Image.new('L', (241, 1), color=0xFF)
+            for x in range(198):
+                gradient.putpixel((x, 0), int(255 * (x / 198)))
+            return gradient.resize((241, 241))
+
+        return ASSET_CACHE.images.get_or_create(('cover-gradient', 241), create)
+
+    @staticmethod
+    def get_average_color(image: Image.Image):
+        return ASSET_CACHE.average_color(image)
+
+    @staticmethod
+    def choose_text_color(background_color: tuple[int, int, int]):
+        r, g, b = background_color
+        brightness = 0.299 * r + 0.587 * g + 0.114 * b
+        return (255, 255, 255) if brightness < 128 else (0, 0, 0)
+
+    @staticmethod
+    def get_grade(score: int):
+        if score >= 9900000:
+            return 'ex+'
+        elif score >= 9800000:
+            return 'ex'
+        elif score >= 9500000:
+            return 'aa'
+        elif score >= 9200000:
+            return 'a'
+        elif score >= 8900000:
+            return 'b'
+        elif score >= 8600000:
+            return 'c'
+        else:
+            return 'd'
+
+    @staticmethod
+    def get_diamond(rating):
+        if not isinstance(rating, int):
+            return 'off'
+        if rating >= 1300:
+            return '7'
+        elif rating >= 1250:
+            return '6'
+        elif rating >= 1200:
+            return '5'
+        elif rating >= 1100:
+            return '4'
+        elif rating >= 1000:
+            return '3'
+        elif rating >= 700:
+            return '2'
+        elif rating >= 350:
+            return '1'
+        else:
+            return '0'
+
+    @staticmethod
+    def score2str(score: int):
+        formatted_number = str(score).zfill(8)
+        formatted_number = f"{formatted_number[:2]}'{formatted_number[2:5]}'{formatted_number[5:]}"
+        return formatted_number
+
+    @staticmethod
+    def user_code2str(user_code: str):
+        return f"{user_code[:3]} {user_code[3:6]} {user_code[6:]}"
+
+    @staticmethod
+    def rating2str(rating: int):
+        decimal = rating % 100
+        former = rating // 100
+        return f"{str(former)}.{str(decimal).zfill(2)}"
+
+    @staticmethod
+    def write_boarder(draw: ImageDraw.Draw, pos: tuple[int, int], text, fill, font, shadow_color):
+        x, y = pos
+        draw.text((x - 2, y - 2), text, fill=shadow_color, font=font)
+        draw.text((x + 2, y - 2), text, fill=shadow_color, font=font)
+        draw.text((x - 2, y + 2), text, fill=shadow_color, font=font)
+        draw.text((x + 2, y + 2), text, fill=shadow_color, font=font)
+        draw.text((x - 1, y - 1), text, fill=shadow_color, font=font)
+        draw.text((x + 1, y - 1), text, fill=shadow_color, font=font)
+        draw.text((x - 1, y + 1), text, fill=shadow_color, font=font)
+        draw.text((x + 1, y + 1), text, fill=shadow_color, font=font)
+        draw.text((x - 2, y), text, fill=shadow_color, font=font)
+        draw.text((x + 2, y), text, fill=shadow_color, font=font)
+        draw.text((x, y + 2), text, fill=shadow_color, font=font)
+        draw.text((x, y - 2), text, fill=shadow_color, font=font)
+        draw.text((x, y), text, fill=fill, font=font)
+
+
+_renderer = None
+
+
+def init_render_process(song_list_path: str = SONGLIST_PATH, warm_up: bool = True):
+    """
+    initializer of rendering worker processes: loads the songlist and the assets once per process.
+    the cover color index is built by the parent before the pool starts, processes only load it.
+    an exception here would break the whole pool, a failed warm-up only costs the first render its speed.
+    """
+    global _renderer
+    _renderer = B30Renderer(SongList(song_list_path))
+    if warm_up:
+        try:
+            ASSET_CACHE.warm_up(build_index=False)
+        except Exception as e:
+            print("render process warm-up failed:", e)
+
+
+def encode(img: Image.Image, options: tuple = None) -> bytes:
+    """
+    encodes an image with options from encoding_options(), in memory.
+    """
+    image_format, quality, compress_level, preview_width = options or encoding_options()
+    if preview_width is not None and preview_width < img.width:
+        img = img.resize((preview_width, round(img.height * preview_width / img.width)), Image.BILINEAR,
+                         reducing_gap=2.0)
+    buffer = io.BytesIO()
+    if image_format == 'png':
+        img.save(buffer, format='PNG', compress_level=compress_level)
+    elif image_format == 'webp':
+        img.save(buffer, format='WEBP', quality=quality, method=0)
+    else:
+        img.convert('RGB').save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def render_b30_bytes(rows, user_name: str, user_code: str, rating: int, character_id: int, is_character_uncapped,
+                     style='chieri', options: tuple = None) -> bytes:
+    """
+    renders a b30 in a worker process set up by init_render_process and returns it encoded with options.
+    """
+    img = _renderer.draw_b30(rows, user_name, user_code, rating, character_id, is_character_uncapped, style)
+    return encode(img, options)
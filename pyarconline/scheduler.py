@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+from .config import REFRESH_INTERVAL
+from .utils import FriendManager
+from .worker import WorkerLauncher
+
+
+class RefreshScheduler(threading.Thread):
+    """
+    Keeps the scores of recently used friends warm in the background.
+
+    Every interval seconds the friend list is polled once (one userinfo call), and every used friend whose
+    recent_score.time_played advanced since the last poll gets a background b30 refresh. The b30 planner
+    only fetches the charts that could have changed the b30, and foreground requests always run first.
+    Friends are refreshed most recently requested first.
+    """
+
+    def __init__(self, launcher: WorkerLauncher, friend_manager: FriendManager, interval: float = REFRESH_INTERVAL):
+        threading.Thread.__init__(self, name="refresh-scheduler", daemon=True)
+        self.launcher = launcher
+        self.friend_manager = friend_manager
+        self.interval = interval
+        self.last_seen = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print("refresh failed:", e)
+
+    def stop(self):
+        self.stopped.set()
+
+    @staticmethod
+    def last_played(friend: dict) -> int:
+        recent_score = friend.get("recent_score")
+        if not recent_score:
+            return 0
+        return recent_score[0].get("time_played", 0)
+
+    def poll(self):
+        """
+        polls the friend list once and queues a refresh for every used friend who played since the last poll.
+        :return: number of queued refreshes
+        """
+        asyncio.run(self.friend_manager.update_friend())
+        slots = self.friend_manager.slots
+        active = []
+        for friend in self.friend_manager.friends:
+            user_id = friend['user_id']
+            last_played = self.last_played(friend)
+            if user_id not in slots or last_played <= self.last_seen.get(user_id, -1):
+                continue
+            self.last_seen[user_id] = last_played
+            active.append(friend)
+        active.sort(key=lambda curr_friend: slots.get(curr_friend['user_id'], 0), reverse=True)
+        for friend in active:
+            self.launcher.submit(friend, 'b30', priority=WorkerLauncher.BACKGROUND, json_only=True)
+        return len(active)
@@ -0,0 +1,310 @@
+import sqlite3
+
+from .config import DB_PATH, SCORE_BATCH_SIZE
+from .potential import count_potentials
+
+SCORE_COLUMNS = ('idx', 'difficulty', 'title', 'rating', 'play_time', 'time_stamp', 'score', 'clear_type', 'potential')
+_SCORE_SELECT = ', '.join(SCORE_COLUMNS)
+
+
+def connect(path: str = DB_PATH):
+    """
+    opens b30data.db in WAL mode, so readers (drawing, json export) never wait for a running refresh
+    and the writer never waits for them.
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-16000')
+    return conn
+
+
+class ScoreStore:
+    """
+    Score storage of every tracked friend, kept in one table keyed by (user_id, idx, difficulty).
+
+    Rows are returned with the columns of SCORE_COLUMNS, in that order, so they can be indexed
+    the same way the old per-user scoreTable_<user_id> rows were.
+    """
+
+    def __init__(self, conn: sqlite3.Connection = None, batch_size: int = SCORE_BATCH_SIZE):
+        self.conn = conn if conn is not None else connect()
+        self.cursor = self.conn.cursor()
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_checks = []
+        self.pending_sweeps = []
+        self.init_schema()
+
+    def init_schema(self):
+        self.cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS tracked_user (
+            user_id INTEGER PRIMARY KEY NOT NULL
+            );
+        CREATE TABLE IF NOT EXISTS score (
+            user_id INTEGER NOT NULL,
+            idx INTEGER NOT NULL,
+            difficulty INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            rating TEXT NOT NULL,
+            play_time INTEGER NOT NULL,
+            time_stamp INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            clear_type INTEGER NOT NULL,
+            potential REAL NOT NULL,
+            PRIMARY KEY (user_id, idx, difficulty)
+            ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS score_user_potential ON score (user_id, potential DESC);
+        CREATE TABLE IF NOT EXISTS score_check (
+            user_id INTEGER NOT NULL,
+            idx INTEGER NOT NULL,
+            difficulty INTEGER NOT NULL,
+            checked_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, idx, difficulty)
+            ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user_sync (
+            user_id INTEGER PRIMARY KEY NOT NULL,
+            last_played INTEGER NOT NULL
+            );
+        CREATE TABLE IF NOT EXISTS chart_sweep (
+            idx INTEGER NOT NULL,
+            difficulty INTEGER NOT NULL,
+            swept_at INTEGER NOT NULL,
+            user_count INTEGER NOT NULL,
+            PRIMARY KEY (idx, difficulty)
+            ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user(
+            id TEXT PRIMARY KEY NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_code TEXT NOT NULL
+            );
+        ''')
+        # several workers may open the store at once, only one of them gets to migrate
+        self.cursor.execute('BEGIN IMMEDIATE')
+        self.migrate()
+        self.conn.commit()
+
+    def migrate(self):
+        """
+        moves the rows of the legacy scoreTable_<user_id> tables into the score table and drops them.
+        """
+        self.cursor.execute('''
+        SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'scoreTable\\_%' ESCAPE '\\'
+        ''')
+        for (table_name,) in self.cursor.fetchall():
+            user_id = table_name[len('scoreTable_'):]
+            if not user_id.isdigit():
+                continue
+            user_id = int(user_id)
+            self.cursor.execute('INSERT OR IGNORE INTO tracked_user (user_id) VALUES (?)', (user_id,))
+            self.cursor.execute(f'''
+            INSERT OR REPLACE INTO score (user_id, {_SCORE_SELECT})
+            SELECT ?, {_SCORE_SELECT} FROM "{table_name}"
+            ''', (user_id,))
+            self.cursor.execute(f'DROP TABLE "{table_name}"')
+
+    def track_user(self, user_id: int):
+        self.cursor.execute('INSERT OR IGNORE INTO tracked_user (user_id) VALUES (?)', (user_id,))
+        self.conn.commit()
+
+    def forget_user(self, user_id: int):
+        """
+        stops tracking a user and drops its score checks, e.g. once it is no longer a friend of the account.
+        its scores are kept, they are still valid lower bounds if it is added again.
+        """
+        self.conn.execute('DELETE FROM score_check WHERE user_id = ?', (user_id,))
+        self.conn.execute('DELETE FROM tracked_user WHERE user_id = ?', (user_id,))
+        self.conn.commit()
+
+    def tracked_users(self) -> set:
+        self.cursor.execute('SELECT user_id FROM tracked_user')
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def get_user_code(self, user_id: int) -> str:
+        self.cursor.execute('SELECT user_code FROM user WHERE user_id = ?', (user_id,))
+        user_code = self.cursor.fetchone()
+        return '' if user_code is None else user_code[0]
+
+    def get_scores(self, user_id: int):
+        self.cursor.execute(f'''
+        SELECT {_SCORE_SELECT} FROM score WHERE user_id = ? ORDER BY potential DESC
+        ''', (user_id,))
+        return self.cursor.fetchall()
+
+    def get_top_scores(self, user_id: int, limit: int = 33):
+        self.cursor.execute(f'''
+        SELECT {_SCORE_SELECT} FROM score WHERE user_id = ? ORDER BY potential DESC LIMIT ?
+        ''', (user_id, limit))
+        return self.cursor.fetchall()
+
+    def iter_scores(self, user_id: int, difficulty: int = None, min_rating: float = None, max_rating: float = None,
+                    played_after: int = None, fetch_size: int = 200):
+        """
+        generator over the stored scores of a user, best potential first, reading fetch_size rows at a time
+        from its own cursor, so memory use does not depend on the number of rows.
+        :param difficulty: only charts of this difficulty
+        :param min_rating: only charts rated min_rating or more
+        :param max_rating: only charts rated max_rating or less
+        :param played_after: only scores set after this time_played
+        """
+        conditions = ['user_id = ?']
+        params = [user_id]
+        if difficulty is not None:
+            conditions.append('difficulty = ?')
+            params.append(difficulty)
+        if min_rating is not None:
+            conditions.append('CAST(rating AS REAL) >= ?')
+            params.append(min_rating)
+        if max_rating is not None:
+            conditions.append('CAST(rating AS REAL) <= ?')
+            params.append(max_rating)
+        if played_after is not None:
+            conditions.append('play_time > ?')
+            params.append(played_after)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f'''
+            SELECT {_SCORE_SELECT} FROM score WHERE {' AND '.join(conditions)} ORDER BY potential DESC
+            ''', params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def recompute_potentials(self, constants: dict, user_id: int = None) -> int:
+        """
+        brings the rating and potential of stored scores in line with the given chart constants
+        (see DifficultyRatingList.constants), for one user or for everyone. potentials are computed
+        in one batch (see count_potentials) and only rows that changed are written.
+        :return: number of updated rows
+        """
+        self.flush()
+        if user_id is None:
+            self.cursor.execute('SELECT user_id, idx, difficulty, rating, score, potential FROM score')
+        else:
+            self.cursor.execute('''
+            SELECT user_id, idx, difficulty, rating, score, potential FROM score WHERE user_id = ?
+            ''', (user_id,))
+        rows = [row for row in self.cursor.fetchall() if (row[1], row[2]) in constants]
+        charts = [constants[(row[1], row[2])] for row in rows]
+        potentials = count_potentials([row[4] for row in rows], [chart[1] for chart in charts])
+        updates = [(rating, potential, row[0], row[1], row[2])
+                   for row, (rating, _), potential in zip(rows, charts, potentials)
+                   if row[3] != rating or row[5] != potential]
+        self.cursor.executemany('''
+        UPDATE score SET rating = ?, potential = ? WHERE user_id = ? AND idx = ? AND difficulty = ?
+        ''', updates)
+        self.conn.commit()
+        return len(updates)
+
+    def upsert(self, user_id: int, idx: int, difficulty: int, title: str, rating: str, play_time: int,
+               time_stamp: int, score: int, clear_type: int, potential: float):
+        """
+        buffers an upsert. buffered rows are written with one executemany and committed
+        once batch_size of them piled up, or when commit() is called.
+        """
+        self.pending.append((user_id, idx, difficulty, title, rating, play_time, time_stamp, score, clear_type,
+                             potential))
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def merge_score(self, user_id: int, idx: int, difficulty: int, title: str, rating: str, play_time: int,
+                    score: int, clear_type: int, potential: float):
+        """
+        stores a score that is known to have been reached, unless a higher one is stored already.
+        the fetch time of the row is left alone (0 for a new row): other plays may be missing from it.
+        """
+        self.flush()
+        self.cursor.execute('''
+        INSERT INTO score (user_id, idx, difficulty, title, rating, play_time, time_stamp, score, clear_type, potential)
+        VALUES (?,?,?,?,?,?,0,?,?,?)
+        ON CONFLICT (user_id, idx, difficulty)
+        DO UPDATE SET rating=excluded.rating, play_time=excluded.play_time, score=excluded.score, clear_type=excluded.clear_type, potential=excluded.potential
+        WHERE excluded.score > score.score
+        ''', (user_id, idx, difficulty, title, rating, play_time, score, clear_type, potential))
+
+    def get_last_played(self, user_id: int) -> int:
+        """
+        :return: time_played of the most recent play of the user seen so far, 0 if none was seen
+        """
+        self.cursor.execute('SELECT last_played FROM user_sync WHERE user_id = ?', (user_id,))
+        last_played = self.cursor.fetchone()
+        return 0 if last_played is None else last_played[0]
+
+    def set_last_played(self, user_id: int, last_played: int):
+        self.cursor.execute('''
+        INSERT INTO user_sync (user_id, last_played) VALUES (?,?)
+        ON CONFLICT (user_id) DO UPDATE SET last_played=max(last_played, excluded.last_played)
+        ''', (user_id, last_played))
+
+    def mark_checked(self, user_ids, idx: int, difficulty: int, checked_at: int):
+        """
+        buffers the fact that the scores of user_ids on a chart were known at checked_at,
+        whether or not they have a score on it.
+        """
+        self.pending_checks.extend((user_id, idx, difficulty, checked_at) for user_id in user_ids)
+        if len(self.pending_checks) >= self.batch_size:
+            self.commit()
+
+    def get_checks(self, user_id: int) -> dict:
+        """
+        :return: checked_at of every checked chart of the user, by (idx, difficulty)
+        """
+        self.cursor.execute('SELECT idx, difficulty, checked_at FROM score_check WHERE user_id = ?', (user_id,))
+        return {(idx, difficulty): checked_at for idx, difficulty, checked_at in self.cursor.fetchall()}
+
+    def record_sweep(self, idx: int, difficulty: int, swept_at: int, user_count: int):
+        """
+        buffers that a chart was swept, written with the next flush like scores and checks.
+        """
+        self.pending_sweeps.append((idx, difficulty, swept_at, user_count))
+        if len(self.pending_sweeps) >= self.batch_size:
+            self.commit()
+
+    def get_sweeps(self) -> dict:
+        """
+        :return: swept_at of every swept chart, by (idx, difficulty)
+        """
+        self.cursor.execute('SELECT idx, difficulty, swept_at FROM chart_sweep')
+        return {(idx, difficulty): swept_at for idx, difficulty, swept_at in self.cursor.fetchall()}
+
+    def flush(self):
+        if self.pending_checks:
+            self.cursor.executemany('''
+            INSERT INTO score_check (user_id, idx, difficulty, checked_at) VALUES (?,?,?,?)
+            ON CONFLICT (user_id, idx, difficulty) DO UPDATE SET checked_at=excluded.checked_at
+            ''', self.pending_checks)
+            self.pending_checks = []
+        if self.pending_sweeps:
+            self.cursor.executemany('''
+            INSERT OR REPLACE INTO chart_sweep (idx, difficulty, swept_at, user_count) VALUES (?,?,?,?)
+            ''', self.pending_sweeps)
+            self.pending_sweeps = []
+        if not self.pending:
+            return
+        self.cursor.executemany('''
+        INSERT INTO score (user_id, idx, difficulty, title, rating, play_time, time_stamp, score, clear_type, potential)
+        VALUES (?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT (user_id, idx, difficulty)
+        DO UPDATE SET rating=excluded.rating, play_time=excluded.play_time, time_stamp=excluded.time_stamp, score=excluded.score, clear_type=excluded.clear_type, potential=excluded.potential
+        ''', self.pending)
+        self.pending = []
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+
+    def rollback(self):
+        self.pending = []
+        self.pending_checks = []
+        self.pending_sweeps = []
+        self.conn.rollback()
+
+    @staticmethod
+    def to_dicts(rows):
+        return [dict(zip(SCORE_COLUMNS, row)) for row in rows]
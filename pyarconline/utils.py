@@ -1,15 +1,25 @@
+import array
+import asyncio
+import concurrent.futures
 import re
 import string
+import threading
 import time
 import random
 import requests
+import requests.adapters
 import requests.utils
 import requests.cookies
 import json
-from bs4 import BeautifulSoup
 import os
 from pyarconline import exceptions
-from .config import SAVE_PATH, FRIEND_LIST_PATH, RATINGS_PATH, RATINGS_OLD_PATH
+from .ratelimiter import RateLimiter, DEFAULT_LIMITER
+from .friendslots import FriendSlots
+from .storage import ScoreStore
+from .datacache import load_compiled
+from .potential import count_potential, count_potentials
+from .config import SAVE_PATH, RATINGS_PATH, RATINGS_OLD_PATH, WEBAPI_BASE_URL, WEBAPI_POOL_SIZE, \
+    USER_AGENT, USERINFO_TTL, FRIEND_SLOT_RESERVE, SONGLIST_CACHE_PATH, RATINGS_CACHE_PATH
 
 
 def check_response(response):
@@ -27,11 +37,16 @@ class WebapiUtils:
     the transmission of data to the server.
     """
 
-    def __init__(self):
+    def __init__(self, base_url: str = WEBAPI_BASE_URL, pool_size: int = WEBAPI_POOL_SIZE,
+                 limiter: RateLimiter = DEFAULT_LIMITER, retries: int = 3):
+        self.base_url = base_url.rstrip('/')
+        self.limiter = limiter
+        self.retries = retries
         self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent':
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'User-Agent': USER_AGENT})
 
     @staticmethod
     def create_boundary_str() -> str:
@@ -40,44 +55,63 @@ class WebapiUtils:
         boundary = f"----WebKitFormBoundary{random_string}"
         return boundary
 
+    @staticmethod
+    def create_form_data(name: str, value: str):
+        """
+        builds a single-field multipart/form-data body the way the official website sends it.
+        :return: (headers, data)
+        """
+        # if you have a better way, please tell me😥
+        boundary = WebapiUtils.create_boundary_str()
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        data = f"""--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n--{boundary}--\r\n"""
+        return headers, data
+
+    def _request(self, method: str, path: str, **kwargs):
+        self.limiter.acquire()
+        response = self.session.request(method, self.base_url + path, **kwargs)
+        try:
+            content = response.json()
+        except ValueError:
+            content = {'success': False, 'status_code': response.status_code}
+        self.limiter.feedback(response.status_code, RateLimiter.parse_retry_after(response.headers.get('Retry-After')))
+        return response.status_code, content
+
+    def _get(self, path: str):
+        # GETs are idempotent, so throttled or failed ones are retried once the limiter allows it
+        for _ in range(self.retries):
+            status_code, content = self._request('GET', path)
+            if status_code != 429 and status_code < 500:
+                break
+        return content
+
+    def _post(self, path: str, **kwargs):
+        return self._request('POST', path, **kwargs)[1]
+
     def authenticate(self):
-        response = self.session.get('https://webapi.lowiro.com/auth/me')
-        return response.json()
+        return self._get('/auth/me')
 
     def userinfo(self):
-        response = self.session.get('https://webapi.lowiro.com/webapi/user/me')
-        return response.json()
+        return self._get('/webapi/user/me')
 
     def clear_statistic(self, difficulty: int):
-        response = self.session.get(f'https://webapi.lowiro.com/webapi/user/me/clear_statistic?difficulty={difficulty}')
-        return response.json()
+        return self._get(f'/webapi/user/me/clear_statistic?difficulty={difficulty}')
 
     def add_friend(self, friend_code: str):
-        # if you have a better way, please tell me😥
-        boundary = self.create_boundary_str()
-        self.session.headers.update({'Content-Type': f'multipart/form-data; boundary={boundary}'})
-        data = f"""--{boundary}\r\nContent-Disposition: form-data; name="friend_code"\r\n\r\n{friend_code}\r\n--{boundary}--\r\n"""
-        response = self.session.post('https://webapi.lowiro.com/webapi/friend/me/add', data=data)
-        self.session.headers.pop('Content-Type')
-        return response.json()
+        headers, data = self.create_form_data('friend_code', friend_code)
+        return self._post('/webapi/friend/me/add', data=data, headers=headers)
 
     def delete_friend(self, friend_id: str):
-        boundary = self.create_boundary_str()
-        self.session.headers.update({'Content-Type': f'multipart/form-data; boundary={boundary}'})
-        data = f"""--{boundary}\r\nContent-Disposition: form-data; name="friend_id"\r\n\r\n{friend_id}\r\n--{boundary}--\r\n"""
-        response = self.session.post('https://webapi.lowiro.com/webapi/friend/me/delete', data=data)
-        self.session.headers.pop('Content-Type')
-        return response.json()
+        headers, data = self.create_form_data('friend_id', friend_id)
+        return self._post('/webapi/friend/me/delete', data=data, headers=headers)
 
     def login(self, email: str, password: str):
         data = {'email': email, 'password': password}
-        response = self.session.post('https://webapi.lowiro.com/auth/login', json=data)
-        return response.json()
+        return self._post('/auth/login', json=data)
 
     def logout(self):
         data = {}
-        response = self.session.post('https://webapi.lowiro.com/auth/logout', json=data)
-        return response.json()
+        return self._post('/auth/logout', json=data)
 
     def my_score(self, difficulty: int, page: int, sort: str, term: str = ""):
         """
@@ -88,24 +122,16 @@ class WebapiUtils:
         :param term: search term
         :return: response
         """
-        response = self.session.get(
-            f'https://webapi.lowiro.com/webapi/score/song/me/all?difficulty={difficulty}&page={page}&sort={sort}&term={term}')
-        return response.json()
+        return self._get(f'/webapi/score/song/me/all?difficulty={difficulty}&page={page}&sort={sort}&term={term}')
 
     def world_rank_score(self, song_id: str, difficulty: int, limit: int = 20):
-        response = self.session.get(
-            f'https://webapi.lowiro.com/webapi/score/song?song_id={song_id}&difficulty={difficulty}&limit={limit}')
-        return response.json()
+        return self._get(f'/webapi/score/song?song_id={song_id}&difficulty={difficulty}&limit={limit}')
 
     def friend_rank_score(self, song_id: str, difficulty: int, limit: int = 30):
-        response = self.session.get(
-            f'https://webapi.lowiro.com/webapi/score/song/friend?song_id={song_id}&difficulty={difficulty}&limit={limit}')
-        return response.json()
+        return self._get(f'/webapi/score/song/friend?song_id={song_id}&difficulty={difficulty}&limit={limit}')
 
     def my_rating(self):
-        response = self.session.get(
-            f'https://webapi.lowiro.com/webapi/score/rating/me')
-        return response.json()
+        return self._get('/webapi/score/rating/me')
 
     def my_rating_progression(self, duration: str):
         """
@@ -113,27 +139,101 @@ class WebapiUtils:
         :param duration: w,m,y,3y,5y
         :return: response
         """
-        response = self.session.get(
-            f'https://webapi.lowiro.com/webapi/score/rating_progression/me?duration={duration}')
-        return response.json()
+        return self._get(f'/webapi/score/rating_progression/me?duration={duration}')
 
     def get_apk_url(self):
-        response = self.session.get(
-            f'https://webapi.lowiro.com/webapi/serve/static/bin/arcaea/apk')
-        return response.json()
+        return self._get('/webapi/serve/static/bin/arcaea/apk')
+
+    def get_cookies(self) -> dict:
+        """
+        returns the cookies of the current (logged in) session, e.g. to share it with AsyncWebapiUtils.
+        """
+        return requests.utils.dict_from_cookiejar(self.session.cookies)
 
 
 class SongList:
-    # todo:to be done
-    def __init__(self, song_list_path):
+    """
+    songlist of the game, with hash indexes by idx, id and title.
+
+    the file is only read when the list is first used, through a compiled cache holding only the fields
+    pyarconline uses (see compile_song_list). the indexes are built when the list is loaded and published
+    together with it as one tuple, so a lookup running during reload() sees either the old or the new list.
+    """
+
+    def __init__(self, song_list_path, cache_path: str = SONGLIST_CACHE_PATH):
         self.song_list_path = song_list_path
-        with open(self.song_list_path, 'r', encoding='UTF-8') as f:
-            self.song_list = json.load(f)
-        self.song_list = self.song_list['songs']
+        self.cache_path = cache_path
+        # (songs, by idx, by id, title indexes by (is_beyond, country)), None until first used
+        self._index = None
+        self.mtime = None
+        self.load_lock = threading.Lock()
+
+    @property
+    def song_list(self) -> list:
+        return self._ensure_loaded()[0]
+
+    def _ensure_loaded(self) -> tuple:
+        index = self._index
+        if index is None:
+            with self.load_lock:
+                if self._index is None:
+                    self.reload()
+                index = self._index
+        return index
 
     def __iter__(self):
         return iter(self.song_list)
 
+    def __len__(self):
+        return len(self.song_list)
+
+    def reload(self):
+        """
+        (re)reads the songlist file and rebuilds the idx/id indexes.
+        """
+        self.mtime = os.path.getmtime(self.song_list_path)
+        songs = load_compiled(self.song_list_path, self.cache_path, self.compile_song_list)
+        by_idx = {}
+        by_id = {}
+        for song in songs:
+            by_idx.setdefault(song['idx'], song)
+            by_id.setdefault(song['id'], song)
+        self._index = (songs, by_idx, by_id, {})
+
+    @staticmethod
+    def compile_song_list(song_list_path: str) -> list:
+        """
+        reads a songlist file, keeping idx, id, titles, aliases, the deleted flag
+        and the localized titles of the difficulties.
+        """
+        with open(song_list_path, 'r', encoding='UTF-8') as f:
+            songs = json.load(f)['songs']
+        compiled = []
+        for song in songs:
+            curr_song = {key: song[key] for key in ('idx', 'id', 'title_localized', 'search_title', 'deleted')
+                         if key in song}
+            curr_song['difficulties'] = [
+                {key: difficulty[key] for key in ('ratingClass', 'title_localized') if key in difficulty}
+                for difficulty in song.get('difficulties', [])]
+            compiled.append(curr_song)
+        return compiled
+
+    def reload_if_changed(self):
+        """
+        reloads the songlist if the file was modified since it was last read.
+        :return: True if the list was reloaded
+        """
+        if self._index is not None and os.path.getmtime(self.song_list_path) != self.mtime:
+            self.reload()
+            return True
+        return False
+
+    def invalidate(self):
+        """
+        drops the list and its indexes, the file is read again when the list is next used.
+        """
+        self._index = None
+
     def get_song_info(self, *args):
         """
         accept one parameter, which is either idx or id.
@@ -146,20 +246,24 @@ class SongList:
         """
         if len(args) > 1 or len(args) == 0:
             raise TypeError('Invalid arguments')
+        _, by_idx, by_id, _ = self._ensure_loaded()
         if isinstance(args[0], int):
-            for song in self.song_list:
-                if song['idx'] == args[0]:
-                    return song
+            index = by_idx
         elif isinstance(args[0], str):
-            for song in self.song_list:
-                if song['id'] == args[0]:
-                    return song
-            raise exceptions.SongNotFoundError(args[0])
+            index = by_id
         else:
             raise TypeError('Invalid arguments')
+        song = index.get(args[0])
+        if song is None:
+            raise exceptions.SongNotFoundError(args[0])
+        return song
 
     def get_song_name(self, song_idx: int, is_beyond: bool, country: str = 'en'):
         song = self.get_song_info(song_idx)
+        return self._song_name(song, is_beyond, country)
+
+    @staticmethod
+    def _song_name(song: dict, is_beyond: bool, country: str):
         if 'deleted' in song:
             return ''
         if country in song['title_localized']:
@@ -176,117 +280,340 @@ class SongList:
         return song_name
 
     def get_all_song_ids(self):
-        ans = []
-        for song in self.song_list:
-            ans.append(song['id'])
-        return ans
+        return list(self._ensure_loaded()[2])
+
+    def _title_index(self, is_beyond: bool, country: str):
+        key = (is_beyond, country)
+        songs, _, _, by_title = self._ensure_loaded()
+        index = by_title.get(key)
+        if index is None:
+            index = {}
+            # exact titles in the requested language win over other localized titles, which win over aliases
+            for song in songs:
+                song_name = self._song_name(song, is_beyond, country)
+                if song_name:
+                    index.setdefault(song_name, song)
+            for song in songs:
+                if 'deleted' in song:
+                    continue
+                for song_name in song['title_localized'].values():
+                    index.setdefault(song_name, song)
+            for song in songs:
+                for aliases in song.get('search_title', {}).values():
+                    for alias in aliases:
+                        index.setdefault(alias, song)
+            by_title[key] = index
+        return index
 
     def get_song_id_idx(self, song_name: str, is_beyond: bool):
-        for song in self.song_list:
-            curr_song_name = self.get_song_name(song['idx'], is_beyond, 'ja')
-            if song_name == curr_song_name:
-                return song['id'], song['idx']
-        raise exceptions.SongNotFoundError(song_name)
+        song = self._title_index(is_beyond, 'ja').get(song_name)
+        if song is None:
+            raise exceptions.SongNotFoundError(song_name)
+        return song['id'], song['idx']
 
 
 class FriendManager:
-    def __init__(self, webapi: WebapiUtils):
+    """
+    Friend list of the logged in account.
+
+    The friend list is a snapshot of userinfo that is reused for ttl seconds. Concurrent refreshes,
+    from any thread or event loop, share one userinfo request.
+    Once fewer than reserve slots are free, the least recently used unpinned friend is deleted
+    in the background, so adding a friend does not have to wait for a deletion.
+    """
+
+    def __init__(self, webapi: WebapiUtils, ttl: float = USERINFO_TTL, reserve: int = FRIEND_SLOT_RESERVE,
+                 slots: FriendSlots = None):
         if not os.path.exists(SAVE_PATH):
             os.makedirs(SAVE_PATH)
-        self.recent_use = {}
-        try:
-            with open(FRIEND_LIST_PATH, 'r') as f:
-                content = json.load(f)
-                for item in content:
-                    self.recent_use[item['friend_id']] = item['recent_use']
-        except FileNotFoundError:
-            with open(FRIEND_LIST_PATH, 'w') as f:
-                f.write('[]')
+        self.slots = slots if slots is not None else FriendSlots()
+        self._store = None
+        self.reserve = reserve
+        self.evict_lock = threading.RLock()
+        self.evicting = False
         self.webapi = webapi
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.in_flight = None
+        self.snapshot_at = 0.0
+        self.friends = []
+        self.by_id = {}
+        self.by_name = {}
         # you should log in first!
         userinfo = self.webapi.userinfo()
         check_response(userinfo)
         userinfo = userinfo['value']
         self.max_friend = userinfo['max_friend']
-        self.friends = userinfo['friends']
+        self.set_friends(userinfo['friends'])
         self.curr_friend = len(self.friends)
         self.user_id = userinfo['user_id']
         self.user_code = userinfo['user_code']
+        self.reserve_slots()
+
+    @property
+    def store(self) -> ScoreStore:
+        # opened on first use, the score tables may still be migrated while the friend list is loaded
+        if self._store is None:
+            self._store = ScoreStore(self.slots.conn)
+        return self._store
+
+    def _forget(self, friend_id: int):
+        """
+        drops a deleted friend from the snapshot and forgets its score checks: while it is not a friend,
+        none of its plays show up in any ranking.
+        """
+        with self.lock:
+            # replaced rather than changed in place, other threads may be reading them
+            self.by_id = {user_id: friend for user_id, friend in self.by_id.items() if user_id != friend_id}
+            self.by_name = {name: user_id for name, user_id in self.by_name.items() if user_id != friend_id}
+        self.store.forget_user(friend_id)
+
+    def _delete_least_used(self, limit: int) -> bool:
+        """
+        deletes the least used unpinned friend if more than limit friend slots are taken.
+        the condition is checked under evict_lock, so concurrent callers never delete more friends than needed.
+        :return: whether a friend was deleted
+        """
+        with self.evict_lock:
+            if self.curr_friend <= limit:
+                return False
+            least_use_id = self.slots.least_used()
+            if least_use_id is None:
+                raise exceptions.PyarconlineException("No friend slot can be freed, every friend is pinned.")
+            response = self.webapi.delete_friend(least_use_id)
+            check_response(response)
+            self.slots.remove(least_use_id)
+            self._forget(least_use_id)
+            self.curr_friend -= 1
+            return True
+
+    async def delete_friend_least_used(self, limit: int = None):
+        """
+        deletes the least used unpinned friend if more than limit (default: all but one) friend slots are taken.
+        """
+        limit = self.max_friend - 1 if limit is None else limit
+        await asyncio.get_running_loop().run_in_executor(None, self._delete_least_used, limit)
 
-    async def save_mapping(self):
-        json_array = [{"friend_id": friend_id, "recent_use": recent_use} for
-                      friend_id, recent_use in
-                      self.recent_use.items()]
-        with open(FRIEND_LIST_PATH, 'w') as json_file:
-            json.dump(json_array, json_file, indent=4)
+    def _evict_in_background(self):
+        try:
+            while self._delete_least_used(self.max_friend - self.reserve):
+                pass
+        except Exception as e:
+            print("friend slot eviction failed:", e)
+        finally:
+            self.evicting = False
+
+    def reserve_slots(self):
+        """
+        starts deleting least used friends in the background if fewer than reserve slots are free.
+        """
+        with self.lock:
+            if self.evicting or self.curr_friend <= self.max_friend - self.reserve:
+                return
+            self.evicting = True
+        threading.Thread(target=self._evict_in_background, name="friend-slot-eviction", daemon=True).start()
 
-    async def delete_friend_least_used(self):
-        least_use_id = min(self.recent_use, key=self.recent_use.get)
-        response = self.webapi.delete_friend(least_use_id)
-        check_response(response)
-        del self.recent_use[least_use_id]
-        self.curr_friend -= 1
+    def pin(self, friend_id: int, pinned: bool = True):
+        """
+        pinned friends keep their slot, they are never deleted to make room for another one.
+        """
+        if friend_id not in self.slots:
+            self.slots.touch(friend_id)
+        self.slots.pin(friend_id, pinned)
+
+    def _add_friend(self, friend_code: str) -> int:
+        # curr_friend only changes under evict_lock, a running eviction cannot free the same slot twice
+        with self.evict_lock:
+            # only deletes if the background eviction could not keep up
+            self._delete_least_used(self.max_friend - 1)
+            old_ids = []
+            for friend in self.friends:
+                old_ids.append(friend['user_id'])
+            response = self.webapi.add_friend(friend_code)
+            check_response(response)
+            self.set_friends(response['value']['friends'])
+            new_user = -1
+            for friend in self.friends:
+                if friend['user_id'] not in old_ids:
+                    new_user = friend['user_id']
+                    break
+            if new_user == -1:
+                raise exceptions.PyarconlineException("Unknown Error. Unable to add friend.")
+            # checks from before it was (again) a friend may have missed plays
+            self.store.forget_user(new_user)
+            self.slots.touch(new_user)
+            self.curr_friend += 1
+        return new_user
 
     async def add_friend(self, friend_code: str):
-        if self.curr_friend == self.max_friend:
-            await self.delete_friend_least_used()
         if not friend_code.isdigit() or len(friend_code) != 9:
             raise exceptions.FriendcodeError(friend_code)
-        old_ids = []
-        for friend in self.friends:
-            old_ids.append(friend['user_id'])
-        response = self.webapi.add_friend(friend_code)
-        check_response(response)
-        self.friends = response['value']['friends']
-        new_user = -1
-        for friend in self.friends:
-            if friend['user_id'] not in old_ids:
-                new_user = friend['user_id']
-                break
-        self.recent_use[new_user] = time.time()
-        self.curr_friend += 1
-        if new_user == -1:
-            raise exceptions.PyarconlineException("Unknown Error. Unable to add friend.")
+        new_user = await asyncio.get_running_loop().run_in_executor(None, self._add_friend, friend_code)
+        self.reserve_slots()
         return new_user
 
     async def record(self, friend_id: int):
-        self.recent_use[friend_id] = time.time()
+        self.slots.touch(friend_id)
 
-    async def update_friend(self):
-        response = self.webapi.userinfo()
-        check_response(response)
-        self.friends = response['value']['friends']
+    def set_friends(self, friends: list):
+        """
+        replaces the friend list snapshot, the lookup dicts are only rebuilt if it changed.
+        """
+        with self.lock:
+            if friends != self.friends:
+                self.by_id = {friend['user_id']: friend for friend in friends}
+                self.by_name = {friend['name']: friend['user_id'] for friend in friends}
+                self.friends = friends
+            self.snapshot_at = time.monotonic()
+
+    async def update_friend(self, max_age: float = None):
+        """
+        refreshes the friend list, unless the snapshot is younger than max_age (default: ttl) seconds.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            if time.monotonic() - self.snapshot_at < max_age:
+                return
+            future = self.in_flight
+            is_owner = future is None
+            if is_owner:
+                future = self.in_flight = concurrent.futures.Future()
+        if not is_owner:
+            await asyncio.shield(asyncio.wrap_future(future))
+            return
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(None, self.webapi.userinfo)
+            check_response(response)
+            self.set_friends(response['value']['friends'])
+            future.set_result(None)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight = None
 
     async def get_friend_info(self, friend_id: int):
         await self.update_friend()
-        for friend in self.friends:
-            if friend['user_id'] == friend_id:
-                self.recent_use[friend_id] = time.time()
-                return friend
-        raise exceptions.FriendNotFoundError(friend_id)
+        friend = self.by_id.get(friend_id)
+        if friend is None:
+            raise exceptions.FriendNotFoundError(friend_id)
+        self.slots.touch(friend_id)
+        return friend
 
     async def get_friend_id(self, name: str):
         await self.update_friend()
-        for friend in self.friends:
-            if friend['name'] == name:
-                return friend['user_id']
-        raise exceptions.FriendNotFoundError(name)
+        user_id = self.by_name.get(name)
+        if user_id is None:
+            raise exceptions.FriendNotFoundError(name)
+        return user_id
 
 
 class DifficultyRatingList:
-    def __init__(self, songList: SongList):
+    """
+    chart constants of every rated chart, read from ratings.json through a compiled cache.
+
+    next to the rating entries, values holds the numeric constants (array of doubles, same order as the entries)
+    and sorted_values the same constants in the order of sorted_by_rating(). value_array() and
+    sorted_value_array() expose them as NumPy arrays without copying.
+    all of them are published together as one index tuple, readers that need more than one of them
+    (see sorted_charts) read it once and never mix two versions of the list.
+    """
+
+    def __init__(self, songList: SongList, cache_path: str = RATINGS_CACHE_PATH):
         if not os.path.exists(SAVE_PATH):
             os.makedirs(SAVE_PATH)
-        self.rating_list = []
+        self.index = ([], array.array('d'), {}, [], array.array('d'))
         self.version = "0.0"
         self.song_list = songList
-        try:
-            with open(RATINGS_PATH, 'r', encoding='UTF-8') as f:
-                ratings = json.load(f)
-                self.rating_list = ratings['value']
-                self.version = ratings['version']
-        except FileNotFoundError:
+        if not os.path.exists(RATINGS_PATH):
             self.save()
+        ratings = load_compiled(RATINGS_PATH, cache_path, self.compile_ratings)
+        self.version = ratings['version']
+        self.build_index(ratings['value'], ratings['values'], ratings['order'])
+
+    @staticmethod
+    def compile_ratings(ratings_path: str) -> dict:
+        """
+        reads a ratings file and parses its constants once:
+        values are the constants as doubles, order the positions of the entries sorted by rating, highest first.
+        """
+        with open(ratings_path, 'r', encoding='UTF-8') as f:
+            ratings = json.load(f)
+        values = array.array('d', (float(chart['rating']) for chart in ratings['value']))
+        order = array.array('i', sorted(range(len(values)), key=values.__getitem__, reverse=True))
+        return {'version': ratings['version'], 'value': ratings['value'], 'values': values, 'order': order}
+
+    def build_index(self, rating_list: list = None, values: array.array = None, order: array.array = None):
+        """
+        rebuilds the (song id, difficulty) index and the list of charts sorted by rating, highest first,
+        and publishes them together with rating_list in one assignment.
+        :param rating_list: new rating entries, default: the current ones
+        :param values: precomputed constants of rating_list, see compile_ratings
+        :param order: precomputed rating order of rating_list, see compile_ratings
+        """
+        if rating_list is None:
+            rating_list = self.rating_list
+        if values is None or order is None:
+            values = array.array('d', (float(chart['rating']) for chart in rating_list))
+            order = array.array('i', sorted(range(len(values)), key=values.__getitem__, reverse=True))
+        sorted_values = array.array('d', (values[i] for i in order))
+        by_chart = {(chart['id'], chart['difficulty']): chart for chart in rating_list}
+        by_rating = [rating_list[i] for i in order]
+        self.index = (rating_list, values, by_chart, by_rating, sorted_values)
+
+    @property
+    def rating_list(self) -> list:
+        return self.index[0]
+
+    @property
+    def values(self) -> array.array:
+        return self.index[1]
+
+    @property
+    def by_chart(self) -> dict:
+        return self.index[2]
+
+    @property
+    def by_rating(self) -> list:
+        return self.index[3]
+
+    @property
+    def sorted_values(self) -> array.array:
+        return self.index[4]
+
+    def value_array(self):
+        import numpy
+
+        return numpy.frombuffer(self.values, dtype=numpy.float64)
+
+    def sorted_value_array(self):
+        import numpy
+
+        return numpy.frombuffer(self.sorted_values, dtype=numpy.float64)
+
+    def constants(self) -> dict:
+        """
+        :return: (rating, numeric constant) of every chart, by (idx, difficulty)
+        """
+        rating_list, values = self.index[:2]
+        return {(chart['idx'], chart['difficulty']): (chart['rating'], value)
+                for chart, value in zip(rating_list, values)}
+
+    def get_chart(self, song_id: str, difficulty: int):
+        """
+        :return: the rating entry of a chart, None if the chart is not rated (i.e. below 8.0)
+        """
+        return self.by_chart.get((song_id, difficulty))
+
+    def sorted_by_rating(self):
+        return self.by_rating
+
+    def sorted_charts(self) -> tuple:
+        """
+        :return: sorted_by_rating() and sorted_values, always of the same version of the list
+        """
+        return self.index[3:5]
 
     def __getitem__(self, index: int):
         if isinstance(index, slice):
@@ -317,14 +644,16 @@ class DifficultyRatingList:
               open(RATINGS_OLD_PATH, 'w', encoding='UTF-8') as target):
             target.write(source.read())
         self.version = "0.0"
-        self.rating_list = []
+        # parsed into a new list, the current one stays in use until the new index is published
+        rating_list = []
         session = requests.session()
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'})
+        session.headers.update({'User-Agent': USER_AGENT})
         response = session.get(
             'https://wikiwiki.jp/arcaea/%E8%AD%9C%E9%9D%A2%E5%AE%9A%E6%95%B0%E8%A1%A8')  # difficulty rating >= 8.0
         response_code = response.status_code
         assert response_code == 200
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(response.text, 'html.parser')
         table_elements = soup.find_all(class_='h-scrollable')
         difficulty_rating_re = r'<a class="rel-wiki-page".*?>(.*?)<\/a>.*?background-color:(.*?);.*?<td style="text-align:center; width:30px;">([0-9\.]*)<\/td><\/tr>'
@@ -366,6 +695,7 @@ class DifficultyRatingList:
                         song_idx = int(input(f"Song {title_nospace} not found in database, please specify its idx."))
                         song_id = self.song_list.get_song_info(song_idx)['id']
                     title_space = self.song_list.get_song_name(song_idx, is_beyond, 'en')
-                self.rating_list.append(
+                rating_list.append(
                     {'idx': song_idx, 'id': song_id, 'title': title_space, 'difficulty': difficulty, 'rating': rating})
+        self.build_index(rating_list)
         self.save()
@@ -1,439 +1,373 @@
-import datetime
-import heapq
-import multiprocessing
-import os
+import asyncio
+import concurrent.futures
+import itertools
 import queue
 import threading
-import sqlite3
 import time
-from PIL import Image, ImageFont, ImageDraw
 
 from pyarconline import WebapiUtils, SongList, DifficultyRatingList, FriendManager
-from .config import CHARACTER_PATH, IMG_SAVE_PATH, DB_PATH, CHIERI_BG_PATH, CHIERI_MASK_PATH, \
-    get_diamond_path, SansSerifFLF_PATH, OpenSans_Regular_PATH, Roboto_Light_PATH, Exo_Regular_PATH, CHIERI_TABLE_PATH, \
-    get_cover_path, get_diff_path, get_grade_path
-from .utils import check_response
-
-sem1 = multiprocessing.Semaphore(0)
-sem2 = multiprocessing.Semaphore(0)
-result_q = queue.Queue()
-
-
-def average(lst):
-    return sum(lst) / len(lst)
+from .config import QUERY_WORKERS, QUERY_CONCURRENCY, RENDER_PROCESSES, MIN_PLAY_INTERVAL
+from .utils import check_response, count_potential
+from .planner import B30Planner
+from .storage import ScoreStore
+from .cache import ASSET_CACHE, RESULT_CACHE
+from .encoding import encoding_options
 
 
 class QueryWorker(threading.Thread):
-    def __init__(self, name: str, q: queue.Queue, song_list: SongList, difficulty_rating: DifficultyRatingList,
-                 webapi: WebapiUtils):
-        threading.Thread.__init__(self, name=name)
+    def __init__(self, name: str, q: queue.PriorityQueue, drawing_q: queue.Queue, song_list: SongList,
+                 difficulty_rating: DifficultyRatingList, webapi: WebapiUtils, friend_manager: FriendManager,
+                 query_concurrency: int = QUERY_CONCURRENCY):
+        threading.Thread.__init__(self, name=name, daemon=True)
         self.queue = q
+        self.drawing_q = drawing_q
         self.song_list = song_list
         self.difficulty_rating = difficulty_rating
         self.webapi = webapi
-        self.q2 = queue.Queue()
-        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self.drawing_worker = DrawingWorker("drawing-worker of " + name, self.q2, song_list)
-        self.drawing_worker.start()
+        self.friend_manager = friend_manager
+        self.store = ScoreStore()
+        # requests only, results are folded in (and written to the database) by this thread
+        self.query_concurrency = max(1, query_concurrency)
+        self.rank_limit = 30
+        self.fetch_pool = concurrent.futures.ThreadPoolExecutor(self.query_concurrency,
+                                                                thread_name_prefix=name + '-fetch')
 
     def run(self):
         while True:
-            sem1.acquire()
-            workload = self.queue.get()  # work_type + friend
-            work_type = workload['work_type']
-            friend = workload['friend']
-            user_id = friend['user_id']
-            _score = friend["recent_score"][0]
-            last_active = 0
-            if "time_played" in _score:
-                last_active = _score["time_played"]
-            table_name = 'scoreTable_' + str(user_id)
-            self.create_score_table(table_name)
-            self.cursor.execute(f'''
-            SELECT * FROM {table_name} ORDER BY potential DESC
-            ''')
-            rows = self.cursor.fetchall()
-            self.cursor.execute('''
-            SELECT name FROM sqlite_master WHERE type='table'
-            ''')
-            tables = [t[0] for t in self.cursor.fetchall()]
-            rows_dict = {(row[0], row[1]): row for row in rows}
-            priority_queue = []
-            song_size = len(self.difficulty_rating)
-
-            if work_type == 'b30':
-                for i in range(song_size):
-                    b30_low_potential = 0.0 if len(priority_queue) < 33 else priority_queue[0]
-                    print("current:", i, "b30_low_potential:", b30_low_potential)
-                    curr_song = self.difficulty_rating[i]
-                    curr_rating = curr_song["rating"]
-                    curr_id = curr_song["id"]
-                    curr_idx = curr_song["idx"]
-                    curr_difficulty = curr_song["difficulty"]
-                    if 20 + int(10 * float(curr_rating)) <= int(10 * b30_low_potential):
-                        print("break", 20 + int(10 * float(curr_rating)), int(10 * b30_low_potential))
-                        break
-                    if (curr_idx, curr_difficulty) in rows_dict and last_active <= \
-                            rows_dict[(curr_idx, curr_difficulty)][5]:
-                        heapq.heappush(priority_queue, rows_dict[(curr_idx, curr_difficulty)][8])
-                        print("continue")
-                        continue
-                    curr_potential = self.update(curr_idx, curr_id, curr_difficulty, user_id, curr_rating, tables)
-                    if curr_potential is not None:
-                        heapq.heappush(priority_queue, curr_potential)
-                    if len(priority_queue) > 33:
-                        heapq.heappop(priority_queue)
-                json_only = workload['json_only']
-                if json_only:
-                    self.cursor.execute(f'''SELECT * FROM {table_name} ORDER BY potential DESC LIMIT 33''')
-                    rows = self.cursor.fetchall()
-                    columns = [desc[0] for desc in self.cursor.description]
-                    json_result = [dict(zip(columns, row)) for row in rows]
-                    result_q.put(json_result)
+            workload = self.queue.get()[-1]  # work_type + friend + future
+            future = workload['future']
+            # a promoted workload is queued twice, the other copy may already be (being) processed
+            if future.running() or future.done():
+                continue
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+            except RuntimeError:
+                continue
+            try:
+                self.process(workload)
+            except Exception as e:
+                self.store.rollback()
+                future.set_exception(e)
+
+    def process(self, workload: dict):
+        """
+        runs the query pass of a workload. the result is delivered through workload['future'],
+        either directly (json_only / 'all') or by handing the workload over to the drawing workers.
+        """
+        work_type = workload['work_type']
+        if work_type == 'sweep':
+            workload['future'].set_result(self.sweep(workload['max_age']))
+            return
+        friend = workload['friend']
+        user_id = friend['user_id']
+        self.store.track_user(user_id)
+        last_active = 0
+        if friend["recent_score"]:
+            last_active = self.ingest_recent_score(user_id, friend["recent_score"][0])
+        rows = self.store.get_scores(user_id)
+        tracked_users = self.store.tracked_users()
+        rows_dict = {(row[0], row[1]): row for row in rows}
+        checks = self.store.get_checks(user_id)
+
+        if work_type == 'b30':
+            charts, values = self.difficulty_rating.sorted_charts()
+            planner = B30Planner(charts, rows_dict, last_active, checks, values=values)
+            for curr_song, response in self.fetch_charts(planner.charts_to_fetch()):
+                planner.record(curr_song, self.update(curr_song, response, user_id, tracked_users))
+            self.store.commit()
+            # rows the planner pruned keep the rating they were fetched with, ratings.json may have changed since
+            self.store.recompute_potentials(self.difficulty_rating.constants(), user_id)
+            json_only = workload['json_only']
+            rows = self.store.get_top_scores(user_id, 33)
+            if json_only:
+                json_result = self.store.to_dicts(rows)
+                workload['future'].set_result(json_result)
+            else:
+                user_code = self.store.get_user_code(user_id)
+                fingerprint = RESULT_CACHE.fingerprint(rows, friend['name'], user_code, friend['rating'],
+                                                       friend['character'], friend['is_char_uncapped'])
+                cached = RESULT_CACHE.get(user_id, fingerprint, workload['encoding'])
+                if cached is not None:
+                    # nothing the image shows changed since it was last drawn
+                    workload['future'].set_result(cached)
                 else:
-                    self.q2.put(workload)
-                    sem2.release()
-            elif work_type == 'all':
-                for i in range(song_size):
-                    curr_song = self.difficulty_rating[i]
-                    curr_rating = curr_song["rating"]
-                    curr_id = curr_song["id"]
-                    curr_idx = curr_song["idx"]
-                    curr_difficulty = curr_song["difficulty"]
-                    if (curr_idx, curr_difficulty) in rows_dict and last_active <= \
-                            rows_dict[(curr_idx, curr_difficulty)][5]:
+                    workload.update(rows=rows, user_code=user_code, fingerprint=fingerprint)
+                    self.drawing_q.put(workload)
+        elif work_type == 'all':
+            def charts_to_fetch():
+                for curr_song in self.difficulty_rating:
+                    key = (curr_song["idx"], curr_song["difficulty"])
+                    if last_active <= checks.get(key, 0) or (key in rows_dict and last_active <= rows_dict[key][5]):
                         print("continue")
                         continue
-                    self.update(curr_idx, curr_id, curr_difficulty, user_id, curr_rating, tables)
+                    yield curr_song
+
+            for curr_song, response in self.fetch_charts(charts_to_fetch()):
+                self.update(curr_song, response, user_id, tracked_users)
+            self.store.commit()
+            # rows that were not refetched may still carry old chart constants
+            self.store.recompute_potentials(self.difficulty_rating.constants(), user_id)
+            workload['future'].set_result(None)
 
-            self.conn.commit()
+    def ingest_recent_score(self, user_id: int, recent_score: dict):
+        """
+        merges the most recent play of a friend into the stored scores.
+        if no other play fits between it and the previous play seen (a play takes MIN_PLAY_INTERVAL at least),
+        it is the only change since then and the stored scores are only stale from the previous play on.
+        :return: time_played after which plays may be missing from the stored scores
+        """
+        last_active = recent_score.get("time_played", 0)
+        chart = self.difficulty_rating.get_chart(recent_score.get("song_id"), recent_score.get("difficulty"))
+        if chart is not None and "score" in recent_score:
+            score = recent_score["score"]
+            self.store.merge_score(user_id, chart["idx"], chart["difficulty"], chart["id"], chart["rating"],
+                                   last_active, score, recent_score.get("clear_type", 0),
+                                   self.count_potential(score, chart["rating"]))
+        last_seen = self.store.get_last_played(user_id)
+        self.store.set_last_played(user_id, last_active)
+        self.store.commit()
+        if last_seen < last_active < last_seen + 2000 * MIN_PLAY_INTERVAL:
+            return last_seen
+        return last_active
+
+    def fetch_charts(self, charts):
+        """
+        fetches friend_rank_score of the given charts, keeping up to query_concurrency requests in flight.
+        charts is consumed lazily, one chart per free slot, so it may decide what to fetch next
+        based on the results yielded so far.
+        :return: generator of (chart, response) in completion order
+        """
+        charts = iter(charts)
+        in_flight = {}
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(in_flight) < self.query_concurrency:
+                    curr_song = next(charts, None)
+                    if curr_song is None:
+                        exhausted = True
+                        break
+                    future = self.fetch_pool.submit(self.webapi.friend_rank_score, curr_song["id"],
+                                                    curr_song["difficulty"], self.rank_limit)
+                    in_flight[future] = curr_song
+                if not in_flight:
+                    return
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield in_flight.pop(future), future.result()
+        finally:
+            for future in in_flight:
+                future.cancel()
 
-    def update(self, idx: int, song_id: str, difficulty: int, user_id: int, rating: str, tables):
-        response = self.webapi.friend_rank_score(song_id, difficulty)
+    def update(self, song: dict, response, user_id: int, tracked_users: set):
+        """
+        stores the scores of every tracked friend in a friend_rank_score response and records which
+        tracked friends the response covered. if the response is not cut off by the rank limit,
+        that includes every tracked friend without a score on the chart. tracked users that are not
+        (or no longer) friends of the account never show up in a ranking, they are not covered.
+        :return: potential of user_id on this chart, None if the user has no score on it
+        """
         check_response(response)
+        idx, song_id, difficulty, rating = song["idx"], song["id"], song["difficulty"], song["rating"]
         data = response["value"]
+        timestamp = int(1000 * time.time())
         potential = None
+        covered = set()
         for item in data:
             curr_user_id = item["user_id"]
-            curr_table_name = 'scoreTable_' + str(curr_user_id)
-            if curr_table_name not in tables:
+            if curr_user_id not in tracked_users:
                 continue
 
-            timestamp = int(1000 * time.time())
             score = item["score"]
             curr_potential = self.count_potential(score, rating)
             if curr_user_id == user_id:
                 potential = curr_potential
-            self.cursor.execute(f'''
-            INSERT INTO {curr_table_name} (idx, difficulty, title, rating, play_time, time_stamp, score, clear_type, potential)
-            VALUES (?,?,?,?,?,?,?,?,?)
-            ON CONFLICT (idx,difficulty)
-            DO UPDATE SET play_time=excluded.play_time, time_stamp=excluded.time_stamp, score=excluded.score, clear_type=excluded.clear_type,potential=excluded.potential
-            ''', (
-                idx, difficulty, song_id, rating, item["time_played"], timestamp, score,
-                item["best_clear_type"], curr_potential))
-        self.conn.commit()
-        time.sleep(0.5)
+            covered.add(curr_user_id)
+            self.store.upsert(curr_user_id, idx, difficulty, song_id, rating, item["time_played"], timestamp, score,
+                              item["best_clear_type"], curr_potential)
+        if len(data) < self.rank_limit:
+            covered = tracked_users & self.friend_manager.by_id.keys()
+        self.store.mark_checked(covered, idx, difficulty, timestamp)
         return potential
 
-    def create_score_table(self, name: str):
-        self.cursor.execute(f'''
-        CREATE TABLE IF NOT EXISTS {name} (
-            idx INTEGER NOT NULL,
-            difficulty KEY NOT NULL,
-            title TEXT NOT NULL,
-            rating TEXT NOT NULL,
-            play_time INTEGER NOT NULL,
-            time_stamp INTEGER NOT NULL,
-            score INTEGER NOT NULL,
-            clear_type INTEGER NOT NULL,
-            potential REAL NOT NULL,
-            PRIMARY KEY (idx, difficulty)
-            )
-        ''')
-        self.conn.commit()
+    def sweep(self, max_age: float = 0):
+        """
+        fetches every rated chart once for the whole set of tracked friends,
+        skipping charts swept less than max_age seconds ago.
+        :return: number of swept charts
+        """
+        tracked_users = self.store.tracked_users()
+        swept = self.store.get_sweeps()
+        oldest = int(1000 * (time.time() - max_age))
+
+        def charts_to_fetch():
+            for curr_song in self.difficulty_rating.sorted_by_rating():
+                if swept.get((curr_song["idx"], curr_song["difficulty"]), 0) > oldest:
+                    continue
+                yield curr_song
+
+        count = 0
+        for curr_song, response in self.fetch_charts(charts_to_fetch()):
+            self.update(curr_song, response, -1, tracked_users)
+            self.store.record_sweep(curr_song["idx"], curr_song["difficulty"], int(1000 * time.time()),
+                                    len(tracked_users))
+            count += 1
+        self.store.commit()
+        print("swept", count, "charts for", len(tracked_users), "friends")
+        return count
 
     @staticmethod
     def count_potential(score: int, rating: str):
-        real_rating = float(rating)
-        if score >= 10000000:
-            ans = real_rating + 2.0
-        elif score >= 9800000:
-            ans = real_rating + 1.0 + (score - 9800000) / 200000
-        else:
-            ans = max(0.0, real_rating + (score - 9500000) / 300000)
-        return round(ans, 5)
+        return count_potential(score, rating)
 
 
 class DrawingWorker(threading.Thread):
-    def __init__(self, name: str, q: queue.Queue, song_list: SongList):
-        threading.Thread.__init__(self, name=name)
+    """
+    Draws the b30 of workloads handed over by the query workers.
+
+    Images are rendered in this thread, or, if a process pool is given, in one of its worker processes
+    (see renderer.init_render_process), which only receive the score rows and user metadata.
+    Either way the result is the encoded image (see renderer.encoding_options), it never touches the disk.
+    """
+
+    def __init__(self, name: str, q: queue.Queue, song_list: SongList,
+                 pool: 'concurrent.futures.ProcessPoolExecutor' = None):
+        threading.Thread.__init__(self, name=name, daemon=True)
         self.q: queue.Queue = q
         self.song_list = song_list
-        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        if not os.path.exists(IMG_SAVE_PATH):
-            os.mkdir(IMG_SAVE_PATH)
+        self.pool = pool
+        self._renderer = None
+
+    @property
+    def renderer(self):
+        # Pillow is only imported once the first image is drawn
+        if self._renderer is None:
+            from .renderer import B30Renderer
+            self._renderer = B30Renderer(self.song_list)
+        return self._renderer
 
     def run(self):
         while True:
-            sem2.acquire()
             workload = self.q.get()
-            work_type = workload['work_type']
-            friend = workload['friend']
-            if work_type == 'b30':
-                user_id = friend['user_id']
-                user_name = friend['name']
-                # todo : can be improved
-                self.cursor.execute(f'''SELECT user_code FROM user WHERE user_id = {user_id}''')
-                user_code = self.cursor.fetchone()
-                if user_code is None:
-                    user_code = ''
-                else:
-                    user_code = user_code[0]
-                rating = friend['rating']
-                character_id = friend['character']
-                is_uncapped = friend['is_char_uncapped']
-                img = self.draw_b30(user_id, user_name, user_code, rating, character_id, is_uncapped)
-                file_name = user_name + "_" + str(user_id) + '.png'
-                file_path = os.path.join(IMG_SAVE_PATH, file_name)
-                img.save(file_path)
-                result_q.put(file_path)
-
-    def draw_b30(self, user_id: int, user_name: str, user_code: str, rating: int,
-                 character_id: int,
-                 is_character_uncapped,
-                 style='chieri'):
-        table_name = 'scoreTable_' + str(user_id)
-        self.cursor.execute(f'''SELECT * FROM {table_name} ORDER BY potential DESC LIMIT 33''')
-        rows = self.cursor.fetchall()
-        if style == 'chieri':
-            # 1. create bg
-            ans = Image.open(CHIERI_BG_PATH).convert('RGBA')
-            # 2. draw b30
-            start_x = 108
-            start_y = 823
-            b30_sum = 0
-            b10_sum = 0
-            for i in range(min(30, len(rows))):
-                single = self.draw_single_b30(rows[i], i + 1)
-                potential = rows[i][8]
-                b30_sum += potential
-                if i < 10:
-                    b10_sum += potential
-                ans.paste(single, (start_x + 542 * (i % 3), start_y + 314 * (i // 3)), single)
-            # 3. draw overflow
-            for i in range(30, min(33, len(rows))):
-                single = self.draw_single_b30(rows[i], i + 1)
-                ans.paste(single, (start_x + 542 * (i % 3), 4010), single)
-            # 4. draw diamond
-            DIAMOND_PATH = get_diamond_path(self.get_diamond(rating))
-            diamond = Image.open(DIAMOND_PATH).convert('RGBA').resize((357, 357))
-            ans.alpha_composite(diamond, (127, 136))
-            # 5. write user_name
-            SansSerifFLF = ImageFont.truetype(SansSerifFLF_PATH, 104)
-            draw = ImageDraw.Draw(ans)
-            draw.text((462, 209), user_name, (255, 255, 255), SansSerifFLF)
-            # 6. write user_code
-            SansSerifFLF = ImageFont.truetype(SansSerifFLF_PATH, 61)
-            draw.text((455, 326), self.user_code2str(user_code), (255, 255, 255), SansSerifFLF)
-            # 7. write rating
-            SansSerifFLF = ImageFont.truetype(SansSerifFLF_PATH, 90)
-            self.write_boarder(draw, (191, 270), self.rating2str(rating), (255, 255, 255), SansSerifFLF, (98, 8, 98))
-            # 8. write b30 and r10
-            b30 = b30_sum / 30
-            r10 = 4 * (rating / 100 - 0.75 * b30)
-            SansSerifFLF = ImageFont.truetype(SansSerifFLF_PATH, 77)
-            draw.text((450, 547), format(b30, ".3f"), (255, 255, 255), SansSerifFLF)
-            draw.text((450, 637), format(r10, ".3f"), (255, 255, 255), SansSerifFLF)
-            # 9. write max_b30
-            max_b30 = (b30_sum + b10_sum) / 40
-            SansSerifFLF = ImageFont.truetype(SansSerifFLF_PATH, 49)
-            draw.text((884, 648), format(max_b30, ".3f"), (255, 255, 255), SansSerifFLF)
-            # 10. draw character
-            char_name = str(character_id)
-            if is_character_uncapped:
-                char_name += 'u'
-            char_name += '.png'
-            char_path = os.path.join(CHARACTER_PATH, char_name)
-            if os.path.exists(char_path):
-                character = Image.open(char_path).convert('RGBA').resize((684, 684))
-                ans.alpha_composite(character, (1154, 119))
-            return ans
-
-    def draw_single_b30(self, data_row, index: int, style='chieri'):
-        idx = data_row[0]  # example: 87
-        id = data_row[2]  # example: fractureray
-        difficulty = data_row[1]  # example: 2
-        score = data_row[6]
-        rating = data_row[3]
-        potential = data_row[8]
-        play_time = int(data_row[4] / 1000)
-        title = self.song_list.get_song_name(idx, difficulty == 3)
-        COVER_PATH = get_cover_path(id, difficulty)
-
-        if style == 'chieri':
-            # 1. cover process
-            cover = Image.open(COVER_PATH).convert('RGBA').resize((241, 241))
-            avg_color = self.get_average_color(cover)
-            ans = Image.new('RGBA', (501, 241), avg_color)
-            gradient = Image.new('L', (241, 1), color=0xFF)
-            for x in range(198):
-                gradient.putpixel((x, 0), int(255 * (x / 198)))
-            gradient = gradient.resize((241, 241))
-            cover.putalpha(gradient)
-            ans.paste(cover, (260, 0), cover)
-            # 2. paste table
-            table = Image.open(CHIERI_TABLE_PATH).convert('RGBA')
-            ans.paste(table, (0, 0), table)
-            # 3. paste diff
-            DIFF_PATH = get_diff_path(difficulty)
-            diff = Image.open(DIFF_PATH).convert('RGBA')
-            ans.paste(diff, (18, 22), diff)
-            # 4. paste grade
-            GRADE_PATH = get_grade_path(self.get_grade(score))
-            grade = Image.open(GRADE_PATH).convert('RGBA').resize((110, 53))
-            ans.paste(grade, (48, 157), grade)
-            # 5. write title
-            roboto_light = ImageFont.truetype(Roboto_Light_PATH, size=37)
-            draw = ImageDraw.Draw(ans)
-            color = self.choose_text_color(avg_color)
-            draw.text((41, 21), title, fill=color, font=roboto_light)
-            # 6. write score
-            roboto_light = ImageFont.truetype(Roboto_Light_PATH, size=51)
-            draw.text((37, 64), self.score2str(score), fill=color, font=roboto_light)
-            # 7. write rating
-            exo_regular = ImageFont.truetype(Exo_Regular_PATH, size=23)
-            draw.text((213, 147), rating, fill=color, font=exo_regular)
-            # 8. write potential
-            exo_regular = ImageFont.truetype(Exo_Regular_PATH, size=37)
-            draw.text((262, 128), '> ' + format(potential, ".2f"), fill=color, font=exo_regular)
-            # 9. write time
-            exo_regular = ImageFont.truetype(Exo_Regular_PATH, size=21)
-            dt_object = datetime.datetime.fromtimestamp(play_time)
-            formatted_time = dt_object.strftime('%Y-%m-%d %H:%M:%S')
-            draw.text((213, 204), formatted_time, fill=color, font=exo_regular)
-            # 10. write index
-            opensans = ImageFont.truetype(OpenSans_Regular_PATH, size=28)
-            shadow_color = (98, 8, 98)
-            text = '#' + str(index)
-            self.write_boarder(draw, (442, 202), text, (255, 255, 255), opensans, shadow_color)
-            # 11. apply mask
-            mask = Image.open(CHIERI_MASK_PATH).convert('L')
-            ans.putalpha(mask)
-            return ans
+            try:
+                workload['future'].set_result(self.process(workload))
+            except Exception as e:
+                workload['future'].set_exception(e)
 
-    @staticmethod
-    def get_average_color(image: Image.Image):
-        pix = image.load()
-        R_list = []
-        G_list = []
-        B_list = []
-        width, height = image.size
-        for x in range(int(width / 5)):
-            for y in range(height):
-                R_list.append(pix[x, y][0])
-                G_list.append(pix[x, y][1])
-                B_list.append(pix[x, y][2])
-        R_average = int(average(R_list))
-        G_average = int(average(G_list))
-        B_average = int(average(B_list))
-        return 20 + R_average, 20 + G_average, 20 + B_average
+    def process(self, workload: dict):
+        work_type = workload['work_type']
+        friend = workload['friend']
+        if work_type == 'b30':
+            user_id = friend['user_id']
+            user_name = friend['name']
+            args = (workload['rows'], user_name, workload['user_code'], friend['rating'], friend['character'],
+                    friend['is_char_uncapped'])
+            options = workload['encoding']
+            from .renderer import render_b30_bytes, encode
 
-    @staticmethod
-    def choose_text_color(background_color: tuple[int, int, int]):
-        r, g, b = background_color
-        brightness = 0.299 * r + 0.587 * g + 0.114 * b
-        return (255, 255, 255) if brightness < 128 else (0, 0, 0)
+            if self.pool is not None:
+                data = self.pool.submit(render_b30_bytes, *args, options=options).result()
+            else:
+                data = encode(self.renderer.draw_b30(*args), options)
+            RESULT_CACHE.put(user_id, workload['fingerprint'], data, options)
+            return data
 
-    @staticmethod
-    def get_grade(score: int):
-        if score >= 9900000:
-            return 'ex+'
-        elif score >= 9800000:
-            return 'ex'
-        elif score >= 9500000:
-            return 'aa'
-        elif score >= 9200000:
-            return 'a'
-        elif score >= 8900000:
-            return 'b'
-        elif score >= 8600000:
-            return 'c'
-        else:
-            return 'd'
 
-    @staticmethod
-    def get_diamond(rating):
-        if not isinstance(rating, int):
-            return 'off'
-        if rating >= 1300:
-            return '7'
-        elif rating >= 1250:
-            return '6'
-        elif rating >= 1200:
-            return '5'
-        elif rating >= 1100:
-            return '4'
-        elif rating >= 1000:
-            return '3'
-        elif rating >= 700:
-            return '2'
-        elif rating >= 350:
-            return '1'
-        else:
-            return '0'
+class WorkerLauncher:
+    """
+    Schedules query/drawing workloads onto a pool of worker threads.
 
-    @staticmethod
-    def score2str(score: int):
-        formatted_number = str(score).zfill(8)
-        formatted_number = f"{formatted_number[:2]}'{formatted_number[2:5]}'{formatted_number[5:]}"
-        return formatted_number
+    every submitted workload carries its own future, so results are always routed back
+    to the caller that submitted them, no matter how many tasks are in flight.
+    workloads are taken by priority (FOREGROUND before BACKGROUND), first come first served within one.
+    """
 
-    @staticmethod
-    def user_code2str(user_code: str):
-        return f"{user_code[:3]} {user_code[3:6]} {user_code[6:]}"
+    FOREGROUND = 0
+    BACKGROUND = 1
 
-    @staticmethod
-    def rating2str(rating: int):
-        decimal = rating % 100
-        former = rating // 100
-        return f"{str(former)}.{str(decimal).zfill(2)}"
+    def __init__(self, song_list: SongList, difficulty_rating: DifficultyRatingList,
+                 webapi: WebapiUtils, friend_manager: FriendManager, query_workers: int = QUERY_WORKERS,
+                 render_processes: int = RENDER_PROCESSES):
+        self.q = queue.PriorityQueue()
+        self.drawing_q = queue.Queue()
+        self.friend_manager = friend_manager
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.counter = itertools.count()
+        self.query_workers = []
+        self.drawing_workers = []
+        self.render_pool = None
+        if render_processes > 0:
+            import multiprocessing
+            from .renderer import init_render_process
 
-    @staticmethod
-    def write_boarder(draw: ImageDraw.Draw, pos: tuple[int, int], text, fill, font, shadow_color):
-        x, y = pos
-        draw.text((x - 2, y - 2), text, fill=shadow_color, font=font)
-        draw.text((x + 2, y - 2), text, fill=shadow_color, font=font)
-        draw.text((x - 2, y + 2), text, fill=shadow_color, font=font)
-        draw.text((x + 2, y + 2), text, fill=shadow_color, font=font)
-        draw.text((x - 1, y - 1), text, fill=shadow_color, font=font)
-        draw.text((x + 1, y - 1), text, fill=shadow_color, font=font)
-        draw.text((x - 1, y + 1), text, fill=shadow_color, font=font)
-        draw.text((x + 1, y + 1), text, fill=shadow_color, font=font)
-        draw.text((x - 2, y), text, fill=shadow_color, font=font)
-        draw.text((x + 2, y), text, fill=shadow_color, font=font)
-        draw.text((x, y + 2), text, fill=shadow_color, font=font)
-        draw.text((x, y - 2), text, fill=shadow_color, font=font)
-        draw.text((x, y), text, fill=fill, font=font)
+            # built once here, render processes only load it
+            ASSET_CACHE.ensure_cover_color_index()
 
+            # forking a process that already runs threads can copy locks in a held state
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.render_pool = concurrent.futures.ProcessPoolExecutor(
+                render_processes, mp_context=multiprocessing.get_context(start_method),
+                initializer=init_render_process, initargs=(song_list.song_list_path,))
+        for i in range(max(1, query_workers)):
+            query_worker = QueryWorker(f"query-worker-{i}", self.q, self.drawing_q, song_list, difficulty_rating,
+                                       webapi, friend_manager)
+            query_worker.start()
+            self.query_workers.append(query_worker)
+        # with a process pool, drawing threads only wait for the processes, one per process keeps them all busy
+        for i in range(max(1, query_workers, render_processes)):
+            drawing_worker = DrawingWorker(f"drawing-worker-{i}", self.drawing_q, song_list, self.render_pool)
+            drawing_worker.start()
+            self.drawing_workers.append(drawing_worker)
 
-class WorkerLauncher:
-    def __init__(self, song_list: SongList, difficulty_rating: DifficultyRatingList,
-                 webapi: WebapiUtils, friend_manager: FriendManager):
-        self.q = queue.Queue()
-        self.friend_manager = friend_manager
-        self.query_worker = QueryWorker("query-worker", self.q, song_list, difficulty_rating, webapi)
-        self.query_worker.start()
+    def submit(self, friend: dict, work_type: str, priority: int = FOREGROUND, **kwargs) -> concurrent.futures.Future:
+        """
+        queues a workload for the given friend and returns its future.
+        identical workloads that are still in flight share the same future, a queued one is promoted
+        if it is resubmitted with a higher priority.
+        'sweep' workloads refresh every tracked friend at once and take no friend.
+        b30 images are encoded with the image_format, quality, compress_level and preview_width kwargs
+        (see renderer.encoding_options).
+        :raises ValueError: if work_type or an encoding option is unknown
+        """
+        if work_type not in ('b30', 'all', 'sweep'):
+            raise ValueError(f'Unknown work type {work_type}')
+        workload = {"work_type": work_type, "friend": friend}
+        if work_type == 'b30':
+            workload["json_only"] = bool(kwargs.get('json_only', False))
+            workload["encoding"] = None if workload["json_only"] else encoding_options(
+                kwargs.get('image_format'), kwargs.get('quality'), kwargs.get('compress_level'),
+                kwargs.get('preview_width'))
+        elif work_type == 'sweep':
+            workload["max_age"] = kwargs.get('max_age', 0)
+        key = (None if friend is None else friend['user_id'], work_type, workload.get("json_only"),
+               workload.get("encoding"))
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is not None:
+                queued, queued_priority = entry
+                if priority < queued_priority and not queued['future'].running():
+                    self.pending[key] = (queued, priority)
+                    self.q.put((priority, next(self.counter), queued))
+                return queued['future']
+            future = concurrent.futures.Future()
+            workload["future"] = future
+            self.pending[key] = (workload, priority)
+            self.q.put((priority, next(self.counter), workload))
+        future.add_done_callback(lambda _: self._finish(key))
+        return future
+
+    def _finish(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
 
     async def start_task(self, user_id: int, work_type: str, **kwargs):
         friend = await self.friend_manager.get_friend_info(user_id)
-        if work_type == 'b30':
-            json_only = False
-            if 'json_only' in kwargs:
-                json_only = kwargs['json_only']
-            self.q.put({"work_type": 'b30', "friend": friend, "json_only": json_only})
-        sem1.release()
-        ans = result_q.get()
-        return ans
+        future = self.submit(friend, work_type, **kwargs)
+        # shielded, so a caller giving up does not cancel a future other callers may share
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def start_sweep(self, max_age: float = 0):
+        future = self.submit(None, 'sweep', max_age=max_age)
+        return await asyncio.shield(asyncio.wrap_future(future))